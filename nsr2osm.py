@@ -4,25 +4,39 @@
 # nsr2osm
 # Converts public transportation stops from Entur NeTex files and matches with OSM for update in JOSM
 # Reads NSR data from Entur NeTEx file (XML)
-# Usage: stop2osm.py [-manual | -upload]
+# Usage: stop2osm.py [-manual | -upload | -resume | -export-history]
 # Creates OSM file with name "nsr_update.osm" and log file "nsr_update_log.txt"
-# Uploads to OSM if -upload is selected
+# Uploads to OSM if -upload is selected, in several changesets
+# Uploads remaining changesets of an interrupted upload if -resume is selected
+# Exports history database to JSON file if -export-history is selected
 
 
 import sys
 import json
-import zipfile
-import csv
+import hashlib
+import sqlite3
 import math
+import re
+import unicodedata
 import copy
 import time
 import datetime
+import concurrent.futures
 import base64
 import os.path
 import urllib.request, urllib.error, urllib.parse
-from io import BytesIO, TextIOWrapper
 from xml.etree import ElementTree as ET
 
+try:
+	import numpy  # Optional, for computing distances in batches
+except ImportError:
+	numpy = None
+
+import nsr_feeds
+import nsr_http
+import nsr_gtfs
+import nsr_netex
+
 
 version = "2.0.0"
 
@@ -37,7 +51,14 @@ osm_api = "https://api.openstreetmap.org/api/0.6/"  # Production database
 overpass_api = "https://overpass-api.de/api/interpreter"
 #overpass_api = "https://overpass.kumi.systems/api/interpreter"
 
-history_filename = "~/Google Drive/Stoppested/nsr_history.json"
+overpass_slots = 2  # Maximum number of concurrent Overpass requests (slots per IP address at Overpass server)
+overpass_national = False  # True to load all of Norway in one Overpass request and partition stops into counties locally
+
+history_filename = "~/Google Drive/Stoppested/nsr_history.sqlite"
+history_json_filename = "~/Google Drive/Stoppested/nsr_history.json"  # Imported when history database is created; target of -export-history
+state_filename = "~/Google Drive/Stoppested/nsr_state.json"  # NSR and OSM versions of matched stops at last run, to skip unchanged stops
+snapshot_filename = "~/.cache/nsr2osm/nsr_snapshot.sqlite"  # NSR stop places at last run, to skip unchanged NeTEx feed and report changes (None to disable)
+snapshot_format = "1"  # Increase when the records from extract_bus_stops change, to discard old snapshots
 
 exclude_counties = []  # Omit counties (two digit ref's)
 #exclude_counties = [03", "11", "15", "18", "30", "34", "38", "42", "46", "50", "54"]
@@ -48,31 +69,42 @@ quays_abroad = ["101150", "15343"]  # Quays just outside of Norway border (to av
 
 out_filename = "nsr_update"
 
+changeset_size = 1000  # Maximum number of elements uploaded in one changeset (maximum 10000 in OSM)
+tile_size = 0.5  # Elements are ordered by tiles of this size (degrees) within each county, for a compact bbox in each changeset
+version_batch = 500  # Number of elements per request when checking current versions in OSM before upload
+
 max_distance = 1.0  # Nodes relocated more than or equal to this distance will get new coordinates (meters)
+candidate_distance = 50.0  # NSR quays within this distance of a bus stop without NSR ref are suggested for the bus stop (meters)
+candidate_match = 0.5  # Minimum name match (0-1) for suggested NSR quay to not be created as a new stop
+candidate_near = 5.0  # Suggested NSR quay within this distance (meters) is not created as a new stop even if names do not match
+
+gtfs_workers = 1  # Number of processes for scanning GTFS stop_times.txt (0 for one per CPU)
 
 ptv1 = False  # True to maintain PTv1 tagging, unless stop is part of PTv2 relation
 ptv1_modify = True  # True to maintain PTv1 tagging when stop/station is updated for other reasons
 
 # Keys used for manual inspection
-manual_keys = ["EDIT", "DISTANCE", "NSR", "NSR_NAME", "NSR_REFERENCE", "USER", "OTHER", "MUNICIPALITY", "VERSION", "STOPTYPE", "SUBMODE", "NSRNOTE", "DELETE", "LAST_USED"]
+manual_keys = ["EDIT", "DISTANCE", "NSR", "NSR_NAME", "NSR_REFERENCE", "USER", "OTHER", "MUNICIPALITY", "VERSION", "STOPTYPE", "SUBMODE", "NSRNOTE", "DELETE", "LAST_USED",
+				"NSR_NAME_MATCH", "NSR_CANDIDATE", "NSR_CANDIDATE_DISTANCE", "NSR_CANDIDATE_NAME", "NSR_CANDIDATE_MATCH"]
 
 
 
-# Open file/api, try up to 5 times, each time with double sleep time
+# Open file/api with shared keep-alive connections, try up to 5 times.
+# Waits as requested by Retry-After from the server, or else with double sleep time each time.
 
 def open_url (url):
 
-	delay = 60  # seconds
 	tries = 0
 	while tries < 5:
 		try:
-			return urllib.request.urlopen(url)
+			return nsr_http.open_url(url)
 		except urllib.error.HTTPError as e:
 			if e.code in [429, 503, 504]:  # Too many requests, Service unavailable or Gateway timed out
+				delay = nsr_http.get_retry_delay(e.headers, tries)
 				if tries  == 0:
 					message ("\n") 
-				message ("\rRetry %i in %ss... " % (tries + 1, delay * (2**tries)))
-				time.sleep(delay * (2**tries))
+				message ("\rRetry %i in %ss... " % (tries + 1, delay))
+				time.sleep(delay)
 				tries += 1
 				error = e
 			elif e.code in [401, 403]:
@@ -86,10 +118,11 @@ def open_url (url):
 				raise
 
 		except urllib.error.URLError as e:  # Mostly "Connection timed out"
+			delay = nsr_http.get_retry_delay(None, tries)
 			if tries  == 0:
 				message ("\n") 
-			message ("\r\tRetry %i in %ss... " % (tries + 1, delay * (2**tries)))
-			time.sleep(delay * (2**tries))
+			message ("\r\tRetry %i in %ss... " % (tries + 1, delay))
+			time.sleep(delay)
 			tries += 1
 	
 	message ("\nHTTP error %i: %s\n" % (error.code, error.reason))	
@@ -128,51 +161,327 @@ def compute_distance (p1, p2):
 
 
 
+# Compute distance between OSM and NSR location for all OSM stops with a matching NSR ref, in one batch.
+# Uses numpy if available.
+# Returns dict of (type, id) -> (distance, relocate, nsr_relocate), where
+# - relocate:		True if distance is at least max_distance (plus extra distance for ways/relations)
+# - nsr_relocate:	True if relocate and the NSR location has changed since last check (according to history)
+
+def compute_relocations (elements):
+
+	keys = []
+	points = []  # (osm lon, osm lat, nsr lon, nsr lat)
+	limits = []  # Minimum distance for relocation
+	history_points = []  # (lon, lat) from history, or None
+
+	for element in elements:
+		if "tags" not in element:
+			continue
+
+		tags = element['tags']
+		if "ref:nsrs" in tags:
+			nsr_ref = tags['ref:nsrs']
+			nsr_stops = stations
+			stop_history = history['stations']
+			extra_distance = 100
+		elif "ref:nsrq" in tags:
+			nsr_ref = tags['ref:nsrq']
+			nsr_stops = quays
+			stop_history = history['quays']
+			extra_distance = 10
+		else:
+			continue
+
+		if nsr_ref not in nsr_stops:
+			continue
+
+		nsr_stop = nsr_stops[ nsr_ref ]
+		if "center" in element:
+			points.append((element['center']['lon'], element['center']['lat'], nsr_stop['lon'], nsr_stop['lat']))
+			limits.append(max_distance + extra_distance)
+		else:
+			points.append((element['lon'], element['lat'], nsr_stop['lon'], nsr_stop['lat']))
+			limits.append(max_distance)
+
+		if nsr_ref in stop_history and "point" in stop_history[ nsr_ref ]:
+			history_points.append(tuple(stop_history[ nsr_ref ]['point']))
+		else:
+			history_points.append(None)
+
+		keys.append((element['type'], element['id']))
+
+	if not keys:
+		return {}
+
+	# Compute distances and relocation flags
+
+	if numpy is not None:
+		lon1, lat1, lon2, lat2 = numpy.radians(numpy.array(points, dtype=float).T)
+		x = (lon2 - lon1) * numpy.cos( 0.5*(lat2+lat1) )
+		y = lat2 - lat1
+		distances = numpy.round(6371000 * numpy.sqrt( x*x + y*y ), 1)  # One decimal
+
+		nsr_points = numpy.array(points, dtype=float)[:, 2:4]
+		old_points = numpy.array([ point if point is not None else (numpy.nan, numpy.nan) for point in history_points ], dtype=float)
+		relocate = distances >= numpy.array(limits)
+		nsr_relocate = relocate & ~numpy.isnan(old_points[:, 0]) & numpy.any(old_points != nsr_points, axis=1)
+
+		distances = distances.tolist()
+		relocate = relocate.tolist()
+		nsr_relocate = nsr_relocate.tolist()
+
+	else:
+		distances = [ compute_distance((point[0], point[1]), (point[2], point[3])) for point in points ]
+		relocate = [ distance >= limit for distance, limit in zip(distances, limits) ]
+		nsr_relocate = [ move and old_point is not None and old_point != (point[2], point[3])
+							for move, old_point, point in zip(relocate, history_points, points) ]
+
+	return dict(zip(keys, zip(distances, relocate, nsr_relocate)))
+
+
+
+# Normalise name for comparison: lower case, without punctuation and with single spaces
+
+def normalise_name (name):
+
+	name = unicodedata.normalize("NFKC", name).lower()
+	name = re.sub(r"[^\w ]+", " ", name)
+	return " ".join(name.split())
+
+
+
+# Get set of trigrams for normalised name, padded so that start and end of words count
+
+def name_trigrams (name):
+
+	name = "  " + name + " "
+	return set(name[ i : i + 3 ] for i in range(len(name) - 2))
+
+
+
+# Build index of normalised names and trigrams for all NSR stations and quays.
+# Precomputed once, so that each comparison with an OSM name is a set intersection.
+
+def build_name_index():
+
+	for stop_type, nsr_stops in [("station", stations), ("quay", quays)]:
+		index = {}
+		for nsr_ref, nsr_stop in iter(nsr_stops.items()):
+			name = normalise_name(nsr_stop.get('name', nsr_stop.get('official_name', "")))
+			index[ nsr_ref ] = (name, name_trigrams(name))
+		nsr_names[ stop_type ] = index
+
+
+
+# Compute similarity between name of NSR stop and given OSM name, from 0 (different) to 1 (equal after normalisation)
+# Dice coefficient of trigrams.
+
+def nsr_name_similarity (stop_type, nsr_ref, osm_name):
+
+	nsr_name, nsr_trigrams = nsr_names[ stop_type ][ nsr_ref ]
+	osm_name = normalise_name(osm_name)
+	if osm_name == nsr_name:
+		return 1.0
+
+	osm_trigrams = name_trigrams(osm_name)
+	return 2.0 * len(nsr_trigrams & osm_trigrams) / (len(nsr_trigrams) + len(osm_trigrams))
+
+
+
+# Escape table for XML attribute values (same escaping as ElementTree)
+
+xml_escape = str.maketrans({'&': "&amp;", '<': "&lt;", '>': "&gt;", '"': "&quot;", '\r': "&#13;", '\n': "&#10;", '\t': "&#09;"})
+
+
+
+# Get indented XML for one element and its children.
+# Parameters:
+# - name:			Element name
+# - attributes:		List of (key, value) attributes
+# - children:		List of (name, attributes) of child elements without children
+# - indent:			Indentation of element
+
+def element_xml (name, attributes, children, indent):
+
+	xml = indent + "<" + name + "".join([ ' %s="%s"' % (key, value.translate(xml_escape)) for key, value in attributes ])
+	if not children:
+		return xml + " />\n"
+
+	lines = [ xml + ">\n" ]
+	for child_name, child_attributes in children:
+		lines.append(indent + "  <" + child_name
+						+ "".join([ ' %s="%s"' % (key, value.translate(xml_escape)) for key, value in child_attributes ]) + " />\n")
+	lines.append(indent + "</" + name + ">\n")
+	return "".join(lines)
+
+
+
+# Open OSM output file and upload spool file (if uploading), for writing elements as they are produced.
+# The upload spool file has one JSON line for each element to upload, with county, tile, action and osmChange XML.
+# Elements with the same group (a stop detached from a way and the remaining way node) must be uploaded together.
+
+def open_osm_files():
+
+	global osm_file, upload_file
+
+	osm_file = open(out_filename + ".osm", "w", encoding="utf-8")
+	osm_file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+	osm_file.write('<osm version="0.6" generator="nsr2osm v%s" upload="false">\n' % version)
+
+	if upload:
+		upload_file = open(out_filename + "_upload.jsonl", "w", encoding="utf-8")
+
+
+
+# Close OSM output file and upload spool file
+
+def close_osm_files():
+
+	osm_file.write("</osm>\n")
+	osm_file.close()
+
+	if upload:
+		upload_file.close()
+
+
+
+# Get tile (column, row) of element for ordering elements in changesets, or (0, 0) if element has no location
+
+def get_tile (element):
+
+	if "lat" in element:
+		point = (element['lon'], element['lat'])
+	elif "center" in element:
+		point = (element['center']['lon'], element['center']['lat'])
+	else:
+		return (0, 0)
+	return (int(math.floor(point[0] / tile_size)), int(math.floor(point[1] / tile_size)))
+
+
+
 # Generate OSM/XML for one OSM element, including for changeset
+# The element is written to the OSM file immediately, and to the upload spool file if uploading.
+# The changeset attribute in the spool file is "0" until the changeset is created (see upload_changesets).
 # Parameter:
 # - element:	Dict of OSM element in same format as returned by Overpass API
 #				'action' contains 'create', 'modify' or 'delete' (or is not present)
 
 def generate_osm_element (element):
 
+	attributes = []
+	children = []
+
 	if element['type'] == "node":
-		osm_element = ET.Element("node", lat=str(element['lat']), lon=str(element['lon']))
+		attributes = [ ("lat", str(element['lat'])), ("lon", str(element['lon'])) ]
 
 	elif element['type'] == "way":
-		osm_element = ET.Element("way")
 		if "nodes" in element:
 			for node_ref in element['nodes']:
-				osm_element.append(ET.Element("nd", ref=str(node_ref)))
+				children.append(("nd", [ ("ref", str(node_ref)) ]))
 
 	elif element['type'] == "relation":
-		osm_element = ET.Element("relation")
 		if "members" in element:
 			for member in element['members']:
-				osm_element.append(ET.Element("member", type=member['type'], ref=str(member['ref']), role=member['role']))
+				children.append(("member", [ ("type", member['type']), ("ref", str(member['ref'])), ("role", member['role']) ]))
 
 	if "tags" in element:
 		for key, value in iter(element['tags'].items()):
-			osm_element.append(ET.Element("tag", k=key, v=value))
+			children.append(("tag", [ ("k", key), ("v", value) ]))
 
-	osm_element.set('id', str(element['id']))
-#	osm_element.set('visible', 'true')
+	attributes.append(("id", str(element['id'])))
 
 	if "user" in element:  # Existing element
-		osm_element.set('version', str(element['version']))
-		osm_element.set('user', element['user'])
-		osm_element.set('uid', str(element['uid']))
-		osm_element.set('timestamp', element['timestamp'])
-		osm_element.set('changeset', str(element['changeset']))
+		attributes += [
+			("version", str(element['version'])),
+			("user", element['user']),
+			("uid", str(element['uid'])),
+			("timestamp", element['timestamp']),
+			("changeset", str(element['changeset']))
+		]
 
 	if "action" in element and element['action'] in ["create", "modify"]:
-		osm_element.set('action', 'modify')
+		attributes.append(("action", "modify"))
 
-	osm_root.append(osm_element)
+	osm_file.write(element_xml(element['type'], attributes, children, "  "))
+
+	# Omit import keys and set changeset placeholder in osmChange
 
 	if upload and "action" in element:
-		action_element = ET.Element(element['action'])
-		action_element.append(osm_element)
-		upload_root.append(action_element)
+		upload_children = [ child for child in children if child[0] != "tag" or child[1][0][1] not in manual_keys ]
+		if "user" in element:
+			upload_attributes = [ (key, "0") if key == "changeset" else (key, value) for key, value in attributes ]
+		else:
+			upload_attributes = attributes + [ ("changeset", "0") ]
+
+		record = {
+			'county': current_county,
+			'tile': get_tile(element),
+			'action': element['action'],
+			'type': element['type'],
+			'id': element['id'],
+			'version': element.get('version', None),
+			'group': element.get('group', "%s/%i" % (element['type'], element['id'])),
+			'xml': element_xml(element['type'], upload_attributes, upload_children, "    ")
+		}
+		upload_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+
+# Index OSM elements from Overpass for the current county.
+# Fills the global element store:
+# - osm_elements:			(type, id) -> element
+# - osm_parent_ways:		Node id -> set of ids of ways which contain the node
+# - osm_parent_relations:	(type, id) -> set of ids of relations which have the element as member
+
+def build_element_store (osm_data):
+
+	osm_elements.clear()
+	osm_parent_ways.clear()
+	osm_parent_relations.clear()
+
+	for element in osm_data['elements']:
+		osm_elements[ (element['type'], element['id']) ] = element
+
+		if "nodes" in element:
+			for node in element['nodes']:
+				if node not in osm_parent_ways:
+					osm_parent_ways[ node ] = set()
+				osm_parent_ways[ node ].add(element['id'])
+
+		if "members" in element:
+			for member in element['members']:
+				member_key = (member['type'], member['ref'])
+				if member_key not in osm_parent_relations:
+					osm_parent_relations[ member_key ] = set()
+				osm_parent_relations[ member_key ].add(element['id'])
+
+
+
+# Check if element is a node in a way
+
+def in_way (element):
+
+	return element['type'] == "node" and element['id'] in osm_parent_ways
+
+
+
+# Check if element is a member of a relation
+
+def in_relation (element):
+
+	return (element['type'], element['id']) in osm_parent_relations
+
+
+
+# Check if element is a member of a PTv2 relation (public_transport or route relation)
+
+def in_ptv2_route (element):
+
+	for relation_id in osm_parent_relations.get((element['type'], element['id']), []):
+		tags = osm_elements[ ("relation", relation_id) ].get('tags', {})
+		if "public_transport" in tags or "type" in tags and tags['type'] == "route":
+			return True
+	return False
 
 
 
@@ -187,7 +496,7 @@ def generate_osm_element (element):
 
 def produce_stop (action, stop_type, nsr_ref, osm_stop, nsr_stop, distance):
 
-	global node_id, osm_data  # osm_way_nodes, osm_relation_members
+	global node_id, osm_data
 
 	log ("\n\n%s: %s #%s\n" % (action.upper(), stop_type, nsr_ref))
 	if distance > 0:
@@ -243,14 +552,16 @@ def produce_stop (action, stop_type, nsr_ref, osm_stop, nsr_stop, distance):
 
 		osm_stop['action'] = "modify"
 
-		if osm_stop['id'] in osm_way_nodes:
+		if in_way(osm_stop):
 			entry = copy.deepcopy(osm_stop)
 			del entry['tags']
+			entry['group'] = "node/%i" % osm_stop['id']  # Both nodes must be uploaded together
 			osm_data['elements'].append(entry)
 #			stops_new += 1
 
 			node_id -= 1
 			osm_stop['id'] = node_id
+			osm_stop['group'] = entry['group']
 			osm_stop['action'] = "create"
 			log ("  Detach stop node from way\n")
 
@@ -269,7 +580,7 @@ def produce_stop (action, stop_type, nsr_ref, osm_stop, nsr_stop, distance):
 				del osm_stop['tags']['highway']
 				log ("  Change tagging from 'highway = bus_stop' to 'amenity = bus_station'\n")
 			check_keys = ["name", "route_ref"]
-			if ptv1_modify and osm_stop['id'] not in osm_ptv2_members:
+			if ptv1_modify and not in_ptv2_route(osm_stop):
 				check_keys += ['public_transport', 'bus']
 
 		elif stop_type == "quay":
@@ -279,7 +590,7 @@ def produce_stop (action, stop_type, nsr_ref, osm_stop, nsr_stop, distance):
 				del osm_stop['tags']['amenity']
 				log ("  Change tagging from 'amenity = bus_station' to 'highway = bus_stop'\n")
 			check_keys = ["name",  "official_name", "ref", "unsigned_ref", "route_ref"]
-			if ptv1_modify and osm_stop['id'] not in osm_ptv2_members:
+			if ptv1_modify and not in_ptv2_route(osm_stop):
 				check_keys += ['public_transport', 'bus']
 
 		for key in check_keys:
@@ -304,12 +615,12 @@ def produce_stop (action, stop_type, nsr_ref, osm_stop, nsr_stop, distance):
 
 		# Keep element if element belongs to or is itself a way or relation
 
-		if (upload and ((osm_stop['id'] in osm_way_nodes)
-						or (osm_stop['id'] in osm_relation_members)
+		if (upload and (in_way(osm_stop)
+						or in_relation(osm_stop)
 						or ("nodes" in osm_stop) or ("members" in osm_stop))):
 
 			osm_stop['tags'] = {}
-			if osm_stop['id'] in osm_ptv2_members:
+			if in_ptv2_route(osm_stop):
 				osm_stop['tags']['fixme'] = "Relocate bus stop? (bus stop not used in NSR routes)"
 				log ("  Check %s #%s (deleted stop/station had way or relation dependencies)\n" % (osm_stop['type'], osm_stop['id']))
 				message ("  *** Check %s #%s (deleted stop/station had way or relation dependencies)\n" % (osm_stop['type'], osm_stop['id']))
@@ -336,9 +647,12 @@ def produce_stop (action, stop_type, nsr_ref, osm_stop, nsr_stop, distance):
 			osm_name = osm_stop['tags']['name']
 
 		if osm_name != nsr_name:
-			log ("  User tagged 'name' as '%s'; in NSR '%s'\n" % (osm_name, nsr_name))
+			similarity = nsr_name_similarity(stop_type, nsr_ref, osm_name)
+			log ("  User tagged 'name' as '%s'; in NSR '%s' (%i%% match)\n" % (osm_name, nsr_name, round(100 * similarity)))
 			if nsr_name:
 				osm_stop['tags']['NSR_NAME'] = nsr_name  # Include NSR name if different
+				osm_stop['tags']['NSR_NAME_MATCH'] = "%i" % round(100 * similarity)
+			name_edits.append((similarity, stop_type, nsr_ref, osm_name, nsr_name))
 
 		log (json.dumps(osm_stop, indent=2, ensure_ascii=False))
 		log ("\n")
@@ -360,12 +674,370 @@ def produce_stop (action, stop_type, nsr_ref, osm_stop, nsr_stop, distance):
 
 
 
-# Read stops from OSM for county, match with NSR and output result
+# Load stops for county from Overpass, plus any parent ways/relations and children
+# Called from worker threads, so it must not modify global data.
+# Parameter:
+# - county_name:	Full name of county
+
+def load_county (county_name):
+
+	query = ('[out:json][timeout:90];'
+			'(area["name"="%s"][admin_level=4];)->.a;'
+			'('
+				'nwr["amenity"="bus_station"](area.a);'
+				'nwr["highway"="bus_stop"](area.a);'
+			')->.b;'
+			'(.b; .b >; .b <;);'
+			'out center meta;' % county_name)
+
+	county_data = {'elements': []}
+	while not county_data['elements']:  # May deliver empty result
+		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
+		file = open_url(request)
+		county_data = json.load(file)
+		file.close()
+
+	return county_data
+
+
+
+# Load stops for all of Norway from Overpass in one request, plus any parent ways/relations and children
+
+def load_norway():
+
+	query = ('[out:json][timeout:600][maxsize:2000000000];'
+			'(area["ISO3166-1"="NO"][admin_level=2];)->.a;'
+			'('
+				'nwr["amenity"="bus_station"](area.a);'
+				'nwr["highway"="bus_stop"](area.a);'
+			')->.b;'
+			'(.b; .b >; .b <;);'
+			'out center meta;')
+
+	norway_data = {'elements': []}
+	while not norway_data['elements']:  # May deliver empty result
+		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
+		file = open_url(request)
+		norway_data = json.load(file)
+		file.close()
+
+	return norway_data
+
+
+
+# Load county boundaries from Kartverket api.
+# Returns dict of county_id -> list of polygons, each a list of rings with (lon, lat) points, plus bounding box.
+
+def load_county_boundaries (county_ids):
+
+	boundaries = {}
+
+	for county_id in county_ids:
+		file = open_url("https://ws.geonorge.no/kommuneinfo/v1/fylker/%s/omrade?utkoordsys=4258" % county_id)
+		county_data = json.load(file)
+		file.close()
+
+		geometry = county_data['omrade']
+		if geometry['type'] == "Polygon":
+			polygons = [ geometry['coordinates'] ]
+		else:
+			polygons = geometry['coordinates']
+
+		boundaries[ county_id ] = []
+		for polygon in polygons:
+			outer = polygon[0]
+			bbox = (min(point[0] for point in outer), min(point[1] for point in outer),
+					max(point[0] for point in outer), max(point[1] for point in outer))
+			boundaries[ county_id ].append((bbox, polygon))
+
+	return boundaries
+
+
+
+# Check if point is inside polygon with holes (even-odd rule across all rings)
+# Format: (lon, lat)
+
+def inside_polygon (point, polygon):
+
+	x, y = point
+	inside = False
+	for ring in polygon:
+		x1, y1 = ring[-1][0], ring[-1][1]
+		for x2, y2 in ring:
+			if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+				inside = not inside
+			x1, y1 = x2, y2
+	return inside
+
+
+
+# Find county for point, or None if outside all given counties
+
+def find_county (point, boundaries):
+
+	for county_id, polygons in iter(boundaries.items()):
+		for bbox, polygon in polygons:
+			if (bbox[0] <= point[0] <= bbox[2] and bbox[1] <= point[1] <= bbox[3]
+					and inside_polygon(point, polygon)):
+				return county_id
+	return None
+
+
+
+# Partition stops for Norway into counties.
+# Stops with NSR ref get the county of the NSR municipality. Other stops are located by point-in-polygon test.
+# Parent ways/relations and children follow the stops they belong to.
+# Returns dict of county_id -> osm_data with the same element order as for Norway.
+
+def partition_counties (norway_data, county_ids):
+
+	# Find county for each stop
+
+	boundaries = None
+	stop_counties = {}  # (type, id) -> county_id
+
+	for element in norway_data['elements']:
+		if "tags" not in element:
+			continue
+		tags = element['tags']
+		if not ("highway" in tags and tags['highway'] == "bus_stop" or "amenity" in tags and tags['amenity'] == "bus_station"):
+			continue
+
+		county_id = None
+		if "ref:nsrs" in tags and tags['ref:nsrs'] in stations:
+			county_id = stations[ tags['ref:nsrs'] ]['municipality'][0:2]
+		elif "ref:nsrq" in tags and tags['ref:nsrq'] in quays:
+			county_id = quays[ tags['ref:nsrq'] ]['municipality'][0:2]
+		else:
+			if boundaries is None:
+				boundaries = load_county_boundaries(county_ids)
+			if "center" in element:
+				point = (element['center']['lon'], element['center']['lat'])
+			else:
+				point = (element['lon'], element['lat'])
+			county_id = find_county(point, boundaries)
+
+		if county_id in county_ids:
+			stop_counties[ (element['type'], element['id']) ] = county_id
+
+	# Add children of stops and parents of stops to the same county
+
+	element_counties = {}  # (type, id) -> set of county_id's
+	for key, county_id in iter(stop_counties.items()):
+		element_counties[ key ] = set([ county_id ])
+
+	for element in norway_data['elements']:
+		key = (element['type'], element['id'])
+		children = []
+		if "nodes" in element:
+			children = [ ("node", node) for node in element['nodes'] ]
+		elif "members" in element:
+			children = [ (member['type'], member['ref']) for member in element['members'] ]
+
+		for child in children:
+			if key in stop_counties:  # Child of stop
+				element_counties.setdefault(child, set()).add(stop_counties[ key ])
+			if child in stop_counties:  # Parent of stop
+				element_counties.setdefault(key, set()).add(stop_counties[ child ])
+
+	# Produce osm_data for each county
+
+	county_data = {}
+	for county_id in county_ids:
+		county_data[ county_id ] = {'elements': []}
+
+	for element in norway_data['elements']:
+		key = (element['type'], element['id'])
+		if key in element_counties:
+			for county_id in sorted(element_counties[ key ]):
+				if len(element_counties[ key ]) > 1:
+					element = copy.deepcopy(element)  # Elements are modified when matching
+				county_data[ county_id ]['elements'].append(element)
+
+	return county_data
+
+
+
+# Build grid index of NSR stops for finding nearby stops.
+# Cells are at least candidate_distance wide, so only the 3x3 cells around a point need to be searched.
+# The cell width in degrees longitude is sized for the northernmost stop (plus one cell), where degrees are shortest.
+# Returns dict with 'height' and 'width' of cells in degrees and 'cells' with dict of (column, row) -> list of NSR refs.
+
+def build_grid (nsr_stops):
+
+	cell_height = candidate_distance / 111000.0  # Degrees latitude
+	max_lat = max([ abs(nsr_stop['lat']) for nsr_stop in nsr_stops.values() ] + [0])
+	max_lat = min(max_lat + cell_height, 89.0)
+
+	grid = {
+		'height': cell_height,
+		'width': cell_height / math.cos(math.radians(max_lat)),  # Degrees longitude
+		'cells': {}
+	}
+
+	for nsr_ref, nsr_stop in iter(nsr_stops.items()):
+		cell = grid_cell((nsr_stop['lon'], nsr_stop['lat']), grid)
+		if cell not in grid['cells']:
+			grid['cells'][ cell ] = []
+		grid['cells'][ cell ].append(nsr_ref)
+
+	return grid
+
+
+
+# Get grid cell for point
+# Format: (lon, lat)
+
+def grid_cell (point, grid):
+
+	return (int(math.floor(point[0] / grid['width'])), int(math.floor(point[1] / grid['height'])))
+
+
+
+# Find NSR stops within candidate_distance of point.
+# Returns list of (distance, nsr_ref), nearest first.
+
+def find_candidates (point, grid, nsr_stops):
+
+	column, row = grid_cell(point, grid)
+	candidates = []
+
+	for cell in [ (column + i, row + j) for i in [-1, 0, 1] for j in [-1, 0, 1] ]:
+		if cell in grid['cells']:
+			for nsr_ref in grid['cells'][ cell ]:
+				nsr_stop = nsr_stops[ nsr_ref ]
+				distance = compute_distance(point, (nsr_stop['lon'], nsr_stop['lat']))
+				if distance <= candidate_distance:
+					candidates.append((distance, nsr_ref))
+
+	return sorted(candidates)
+
+
+
+# Suggest nearest NSR quay which was not found in OSM, for bus stops in OSM without NSR ref.
+# The suggestion is included as extra tags for the bus stop. The NSR quay will not be created as a new stop
+# if the names match (candidate_match) or if the stops are very close (candidate_near).
+# Parameters:
+# - other_stops:	List of OSM stops without NSR ref
+# - nsr_quays:		Dict of NSR quays in county which were not found in OSM
+# Returns number of suggested NSR quays which will not be created.
+
+def suggest_nsr_quays (other_stops, nsr_quays):
+
+	grid = build_grid(nsr_quays)
+	count = 0
+
+	for osm_stop in other_stops:
+		if "highway" not in osm_stop['tags'] or osm_stop['tags']['highway'] != "bus_stop":
+			continue
+
+		if "center" in osm_stop:
+			point = (osm_stop['center']['lon'], osm_stop['center']['lat'])
+		else:
+			point = (osm_stop['lon'], osm_stop['lat'])
+
+		candidates = [ candidate for candidate in find_candidates(point, grid, nsr_quays) if candidate[1] not in quays_abroad ]
+		if not candidates:
+			continue
+
+		osm_name = ""
+		if "name" in osm_stop['tags']:
+			osm_name = osm_stop['tags']['name']
+
+		log ("\n\nSUGGESTION: other stop %s #%s\n" % (osm_stop['type'], osm_stop['id']))
+		for distance, nsr_ref in candidates[:3]:
+			nsr_name = nsr_quays[ nsr_ref ].get('name', nsr_quays[ nsr_ref ].get('official_name', ""))
+			log ("  NSR quay #%s at %.1f meters, name '%s' (%i%% match)\n"
+					% (nsr_ref, distance, nsr_name, round(100 * nsr_name_similarity("quay", nsr_ref, osm_name))))
+
+		distance, nsr_ref = candidates[0]
+		nsr_name = nsr_quays[ nsr_ref ].get('name', nsr_quays[ nsr_ref ].get('official_name', ""))
+		similarity = nsr_name_similarity("quay", nsr_ref, osm_name)
+		osm_stop['tags']['NSR_CANDIDATE'] = nsr_ref
+		osm_stop['tags']['NSR_CANDIDATE_DISTANCE'] = "%.1f" % distance
+		osm_stop['tags']['NSR_CANDIDATE_NAME'] = nsr_name
+		osm_stop['tags']['NSR_CANDIDATE_MATCH'] = "%i" % round(100 * similarity)
+
+		# Do not create the NSR quay as a new stop only if it is likely to be the same stop
+
+		if similarity < candidate_match and distance > candidate_near:
+			log ("  NSR quay #%s will still be created (name match below %i%%)\n" % (nsr_ref, round(100 * candidate_match)))
+
+		elif nsr_ref not in suggested_quays:
+			suggested_quays.add(nsr_ref)
+			count += 1
+
+	return count
+
+
+
+# Get key of matched NSR and OSM stop in match state
+
+def match_key (stop_type, nsr_ref, osm_stop):
+
+	return "%s/%s:%s/%s" % (stop_type, nsr_ref, osm_stop['type'], osm_stop['id'])
+
+
+
+# Get match state entry with NSR version, digest of NSR tags (a quay name may change with the stop place) and OSM version,
+# together with the decision for the stop and the distance between NSR and OSM, to repeat the decision at the next run.
+# Parameters:
+# - decision:	unchanged/modify/relocate/user edit
+# - distance:	Distance from NSR location (meters)
+
+def match_state_entry (nsr_stop, osm_stop, decision, distance):
+
+	digest = hashlib.md5(json.dumps(nsr_stop, sort_keys=True).encode()).hexdigest()[:16]
+	return {
+		'nsr': nsr_stop['version'],
+		'digest': digest,
+		'osm': osm_stop['version'],
+		'decision': decision,
+		'distance': distance
+	}
+
+
+
+# Find matched OSM stops where neither the NSR stop nor the OSM element has changed since last run.
+# Returns dict of (type, id) -> match state entry from last run, with the decision to be repeated.
+
+def find_unchanged_stops (elements):
+
+	unchanged = {}
+	for element in elements:
+		if "tags" not in element:
+			continue
+
+		tags = element['tags']
+		if "ref:nsrs" in tags and tags['ref:nsrs'] in stations:
+			stop_type = "station"
+			nsr_stop = stations[ tags['ref:nsrs'] ]
+			nsr_ref = tags['ref:nsrs']
+		elif "ref:nsrq" in tags and tags['ref:nsrq'] in quays:
+			stop_type = "quay"
+			nsr_stop = quays[ tags['ref:nsrq'] ]
+			nsr_ref = tags['ref:nsrq']
+		else:
+			continue
+
+		state_key = match_key(stop_type, nsr_ref, element)
+		if state_key in match_state:
+			state = match_state[ state_key ]
+			entry = match_state_entry(nsr_stop, element, state['decision'], state.get('distance', 0))
+			if state == entry:  # Entries saved without distance do not match, so those stops are checked again
+				unchanged[ (element['type'], element['id']) ] = state
+
+	return unchanged
+
+
+
+# Match stops from OSM for county with NSR and output result
 # Paramters:
 # - county_id:		Two digit county reference
 # - county_name:	Full name of county
+# - county_data:	Stops for county from Overpass (see load_county)
 
-def process_county (county_id, county_name):
+def process_county (county_id, county_name, county_data):
 
 
 	# Check if tags in NSR and OSM are differnt
@@ -386,50 +1058,34 @@ def process_county (county_id, county_name):
 		return False
 
 
-	global stops_total_modify, stops_total_delete, stops_total_edits, stops_total_others, stops_new
-	global osm_data
+	# Produce output for stop again with decision from last run, and return decision
 
-	message ("\nLoading #%s %s county... " % (county_id, county_name))
-	log ("\n\n*** COUNTY: %s %s\n" % (county_id, county_name))
+	def repeat_decision(stop_type, nsr_ref, osm_stop, nsr_stop, state):
 
-	# Load stops from Overpass, plus any parent ways/relations and children
+		decision = state['decision']
+		if decision != "unchanged":
+			produce_stop (decision, stop_type, nsr_ref, osm_stop, nsr_stop, state['distance'])
+			if decision == "user edit" and state['distance'] > 0:
+				produce_stop ("nsr reference", stop_type, nsr_ref, None, nsr_stop, 0)  # Output NSR stop for reference only
 
-	query = ('[out:json][timeout:90];'
-			'(area["name"="%s"][admin_level=4];)->.a;'
-			'('
-				'nwr["amenity"="bus_station"](area.a);'
-				'nwr["highway"="bus_stop"](area.a);'
-			')->.b;'
-			'(.b; .b >; .b <;);'
-			'out center meta;' % county_name)
+		return decision
 
-	osm_data = {'elements': []}
-	while not osm_data['elements']:  # May deliver empty result
-		request = urllib.request.Request(overpass_api + "?data=" + urllib.parse.quote(query), headers=request_header)
-		file = open_url(request)
-		osm_data = json.load(file)
-		file.close()
 
-	# Make lists of all stop nodes witch are part of ways and relations
+	global stops_total_modify, stops_total_delete, stops_total_edits, stops_total_others, stops_new
+	global osm_data, name_edits, current_county
 
-	osm_way_nodes.clear()
-	osm_relation_members.clear()
-	osm_ptv2_members.clear()
-	count_relations = 0
+	current_county = county_id
 
-	for element in osm_data['elements']:
-		if "nodes" in element:
-			for node in element['nodes']:
-				osm_way_nodes.append(node)
-		if "members" in element:
-			count_relations += 1
-			for member in element['members']:
-				osm_relation_members.append(member['ref'])
-				if "tags" in element:
-					if "public_transport" in element['tags'] or "type" in element['tags'] and element['tags']['type'] == "route":
-						osm_ptv2_members.append(member['ref'])
+	osm_data = county_data
 
-	message ("Connected to %i nodes, %i relations\n" % (len(osm_way_nodes), count_relations))
+	message ("\nMatching #%s %s county... " % (county_id, county_name))
+	log ("\n\n*** COUNTY: %s %s\n" % (county_id, county_name))
+
+	# Index all elements, and all stops which are part of ways and relations
+
+	build_element_store(osm_data)
+
+	message ("Connected to %i nodes, %i relations\n" % (len(osm_parent_ways), sum(1 for key in osm_elements if key[0] == "relation")))
 
 	# Iterate stops from OSM and discover differences between NSR and OSM
 	# The dict osm_data will be modified to include all stops to be output
@@ -443,17 +1099,17 @@ def process_county (county_id, county_name):
 	stops_edit = 0
 	stops_other = 0
 	stops_history = 0
+	stops_unchanged = 0
+
+	unchanged_stops = find_unchanged_stops(osm_data['elements'])
+	relocations = compute_relocations([ element for element in osm_data['elements'] if (element['type'], element['id']) not in unchanged_stops ])
+	other_stops = []
+	name_edits = []
 
-	index = 0
-	the_end = False
-	end_element = osm_data['elements'][-1]  # Iteration will end at this stop
-	osm_stop = None
+	end_index = len(osm_data['elements'])  # Iteration will end at this stop (elements may be appended during iteration)
 
-	while not(the_end):
+	for index in range(end_index):
 		osm_stop = osm_data['elements'][index]
-		index += 1
-		if osm_stop == end_element:
-			the_end = True
 
 		if "tags" in osm_stop:
 
@@ -469,30 +1125,34 @@ def process_county (county_id, county_name):
 
 					stops_nsr += 1
 					station = stations[nsr_ref]
-					relocate = False
-					nsr_relocate = False  # Will become True if location in NSR changed since last check
 					tag_modify = False
-					extra_distance = 0
+					decision = "unchanged"
 
-					# Check location
+					# Repeat decision from last run if neither NSR nor OSM have changed since then
 
-					if "center" in osm_stop:
-						distance = compute_distance((osm_stop['center']['lon'], osm_stop['center']['lat']), (station['lon'], station['lat']))
-						extra_distance = 100
-					else:
-						distance = compute_distance((osm_stop['lon'], osm_stop['lat']), (station['lon'], station['lat']))
+					state_key = match_key("station", nsr_ref, osm_stop)
+					if (osm_stop['type'], osm_stop['id']) in unchanged_stops:
+						new_match_state[ state_key ] = unchanged_stops[ (osm_stop['type'], osm_stop['id']) ]
+						decision = repeat_decision("station", nsr_ref, osm_stop, station, new_match_state[ state_key ])
+						if decision in ["modify", "relocate"]:
+							stops_modify += 1
+						elif decision == "user edit":
+							stops_edit += 1
+						else:
+							stops_unchanged += 1
+						remove_nsr_stop(stations, county_stations, nsr_ref)
+						continue
+
+					# Check location (computed for all stops in county in advance)
 
-					if distance >= max_distance + extra_distance:
-						relocate = True
-						if (nsr_ref in history['stations'] and "point" in history['stations'][ nsr_ref ]
-								and history['stations'][ nsr_ref ]['point'] != [station['lon'], station['lat']]):
-							nsr_relocate = True
-							stops_history += 1
+					distance, relocate, nsr_relocate = relocations[ (osm_stop['type'], osm_stop['id']) ]
+					if nsr_relocate:
+						stops_history += 1
 
 					# Check tags
 
 					check_tags = ["name"]
-					if ptv1 and osm_stop['id'] not in osm_ptv2_members:
+					if ptv1 and not in_ptv2_route(osm_stop):
 						check_tags += ["public_transport", "bus"]
 
 					if different_tags(station, tags, check_tags):
@@ -503,17 +1163,21 @@ def process_county (county_id, county_name):
 					if relocate or tag_modify:
 						if nsr_relocate or relocate and (osm_stop['user'] in user_whitelist or tag_modify):
 							produce_stop ("relocate", "station", nsr_ref, osm_stop, station, distance)
+							decision = "relocate"
 							stops_modify += 1
 						elif tag_modify:
 							produce_stop ("modify", "station", nsr_ref, osm_stop, station, distance)								
+							decision = "modify"
 							stops_modify += 1
 						else:
 							produce_stop ("user edit", "station", nsr_ref, osm_stop, station, distance)
+							decision = "user edit"
 							if distance > 0:
 								produce_stop ("nsr reference", "station", nsr_ref, None, station, 0)  # Output NSR stop for reference only
 							stops_edit += 1
 
-					del stations[ nsr_ref ]
+					new_match_state[ state_key ] = match_state_entry(station, osm_stop, decision, distance)
+					remove_nsr_stop(stations, county_stations, nsr_ref)
 
 				else:
 					produce_stop ("delete", "station", nsr_ref, osm_stop, None, 0)
@@ -529,30 +1193,34 @@ def process_county (county_id, county_name):
 
 					stops_nsr += 1
 					quay = quays[nsr_ref]
-					relocate = False
-					nsr_relocate = False
 					tag_modify = False
-					extra_distance = 0
+					decision = "unchanged"
 
-					# Check location
+					# Repeat decision from last run if neither NSR nor OSM have changed since then
 
-					if "center" in osm_stop:
-						distance = compute_distance((osm_stop['center']['lon'], osm_stop['center']['lat']), (station['lon'], station['lat']))
-						extra_distance = 10
-					else:
-						distance = compute_distance((osm_stop['lon'], osm_stop['lat']), (quay['lon'], quay['lat']))
+					state_key = match_key("quay", nsr_ref, osm_stop)
+					if (osm_stop['type'], osm_stop['id']) in unchanged_stops:
+						new_match_state[ state_key ] = unchanged_stops[ (osm_stop['type'], osm_stop['id']) ]
+						decision = repeat_decision("quay", nsr_ref, osm_stop, quay, new_match_state[ state_key ])
+						if decision in ["modify", "relocate"]:
+							stops_modify += 1
+						elif decision == "user edit":
+							stops_edit += 1
+						else:
+							stops_unchanged += 1
+						remove_nsr_stop(quays, county_quays, nsr_ref)
+						continue
+
+					# Check location (computed for all stops in county in advance)
 
-					if distance >= max_distance + extra_distance:
-						relocate = True
-						if (nsr_ref in history['quays'] and "point" in history['quays'][ nsr_ref ]
-								and history['quays'][ nsr_ref ]['point'] != [quay['lon'], quay['lat']]):
-							nsr_relocate = True
-							stops_history += 1
+					distance, relocate, nsr_relocate = relocations[ (osm_stop['type'], osm_stop['id']) ]
+					if nsr_relocate:
+						stops_history += 1
 
 					# Check tags
 
 					check_tags = ["name", "official_name", "ref", "unsigned_ref", "route_ref"]
-					if ptv1 and osm_stop['id'] not in osm_ptv2_members:
+					if ptv1 and not in_ptv2_route(osm_stop):
 						check_tags += ["public_transport", "bus"]
 
 					if different_tags(quay, tags, check_tags):
@@ -563,17 +1231,21 @@ def process_county (county_id, county_name):
 					if relocate or tag_modify:
 						if nsr_relocate or relocate and (osm_stop['user'] in user_whitelist or tag_modify):
 							produce_stop ("relocate", "quay", nsr_ref, osm_stop, quay, distance)
+							decision = "relocate"
 							stops_modify += 1
 						elif tag_modify:
 							produce_stop ("modify", "quay", nsr_ref, osm_stop, quay, distance)
+							decision = "modify"
 							stops_modify += 1					
 						else:
 							produce_stop ("user edit", "quay", nsr_ref, osm_stop, quay, distance)
+							decision = "user edit"
 							if distance > 0:
 								produce_stop ("nsr reference", "quay", nsr_ref, None, quay, 0)  # Output NSR stop for reference only
 							stops_edit += 1					
 
-					del quays[ nsr_ref ]
+					new_match_state[ state_key ] = match_state_entry(quay, osm_stop, decision, distance)
+					remove_nsr_stop(quays, county_quays, nsr_ref)
 
 				else:
 					produce_stop ("delete", "quay", nsr_ref, osm_stop, None, 0)
@@ -584,29 +1256,39 @@ def process_county (county_id, county_name):
 			else:
 				if "highway" in tags and tags['highway'] == "bus_stop" or "amenity" in tags and tags['amenity'] == "bus_station":
 					produce_stop ("other stop", None, None, osm_stop, None, 0)
+					other_stops.append(osm_stop)
 					stops_other += 1
 
+	# Log user edited names, most different name first
+
+	if name_edits:
+		log ("\n\nNAMES EDITED BY USERS IN %s:\n" % county_name.upper())
+		for similarity, stop_type, nsr_ref, osm_name, nsr_name in sorted(name_edits):
+			log ("  %3i%%  %s #%s: '%s'; in NSR '%s'\n" % (round(100 * similarity), stop_type, nsr_ref, osm_name, nsr_name))
+
+	# Suggest nearby NSR quays which were not found in OSM for other stops, instead of creating duplicates later
+
+	stops_suggested = suggest_nsr_quays(other_stops, county_quays.get(county_id, {}))
+
 	#  Count NSR stations and quays which were not found in OSM. Output later
 	
-	for nsr_ref, station in iter(stations.items()):
-		if station['municipality'][0:2] == county_id:
-#			produce_stop ("new", "station", nsr_ref, None, station, 0)
-			stops_new += 1
-			stops_nsr += 1
+	stops_new += len(county_stations.get(county_id, {}))
 
-	for nsr_ref, quay in iter(quays.items()):
-		if quay['municipality'][0:2] == county_id and nsr_ref not in quays_abroad:  # Omit quays outside of Norway border
-#			produce_stop ("new", "quay", nsr_ref, None, quay, 0)
+	for nsr_ref in county_quays.get(county_id, {}):
+		if nsr_ref not in quays_abroad and nsr_ref not in suggested_quays:  # Omit quays outside of Norway border
 			stops_new += 1
-			stops_nsr += 1
+
+	stops_nsr += stops_new
 
 	# Display summary information
 
 	message ("\n")
 	message ("  Stops in OSM           : %i\n" % stops_osm)
 	message ("  Stops in NSR           : %i\n" % stops_nsr)
+	message ("  Unchanged stops        : %i\n" % stops_unchanged)
 	message ("  User edited stops      : %i\n" % stops_edit)
 	message ("  Other non-NSR stops    : %i\n" % stops_other)
+	message ("  NSR quays suggested    : %i\n" % stops_suggested)
 	message ("  Modified stops         : %i\n" % stops_modify)
 	message ("  Deleted stops          : %i\n" % stops_delete)
 	message ("  New stops (preliminary): %i\n" % stops_new)     # Preliminary count; conclusion later
@@ -624,30 +1306,44 @@ def process_county (county_id, county_name):
 
 
 
+# Remove matched NSR station or quay from nationwide dict and from county bucket
+
+def remove_nsr_stop (nsr_stops, county_stops, nsr_ref):
+
+	entry = nsr_stops.pop(nsr_ref)
+	del county_stops[ entry['municipality'][0:2] ][ nsr_ref ]
+
+
+
 # Output remaining NSR stations and quays which were not found in OSM
 
 def process_new_stops():
 
-	global stops_total_new, osm_data
+	global stops_total_new, osm_data, current_county
 
 	log ("\n\n*** NEW STOPS: Norway\n")
 
-	osm_data = { 'elements': [] }
+	for county_id in sorted(set(county_stations) | set(county_quays)):
+		if county_id in exclude_counties:
+			continue
 
-	for nsr_ref, station in iter(stations.items()):
-		if station['municipality'][0:2] not in exclude_counties:
+		osm_data = { 'elements': [] }
+		current_county = county_id
+
+		for nsr_ref, station in iter(county_stations.get(county_id, {}).items()):
 			produce_stop ("new", "station", nsr_ref, None, station, 0)
 			stops_total_new += 1
 
-	for nsr_ref, quay in iter(quays.items()):
-		if quay['municipality'][0:2] not in exclude_counties and nsr_ref not in quays_abroad:  # Omit quays outside of Norway border
-			produce_stop ("new", "quay", nsr_ref, None, quay, 0)
-			stops_total_new += 1
+		for nsr_ref, quay in iter(county_quays.get(county_id, {}).items()):
+			if nsr_ref not in quays_abroad and nsr_ref not in suggested_quays:  # Omit quays outside of Norway border or suggested for other stop
+				produce_stop ("new", "quay", nsr_ref, None, quay, 0)
+				stops_total_new += 1
 
-	message ("\n\nNew stops in Norway: %i\n" % stops_total_new)
+		for element in osm_data['elements']:
+			generate_osm_element (element)
 
-	for element in osm_data['elements']:
-		generate_osm_element (element)
+	message ("\n\nNew stops in Norway: %i\n" % stops_total_new)
+	message ("NSR quays suggested for other stops in OSM: %i\n" % len(suggested_quays))
 
 
 
@@ -657,38 +1353,94 @@ def process_new_stops():
 def load_nsr_routes():
 
 	url = "https://storage.googleapis.com/marduk-production/outbound/gtfs/rb_norway-aggregated-gtfs-basic.zip"
-	in_file = urllib.request.urlopen(url)
-	zip_file = zipfile.ZipFile(BytesIO(in_file.read()))
+	zip_file = nsr_feeds.open_feed(url)
 
 	# Load routes to discover quays in use from time table data
 
-	file = zip_file.open("stop_times.txt")
-	file_csv = csv.DictReader(TextIOWrapper(file, "utf-8"), fieldnames=['trip_id','stop_id'], delimiter=",")
-	next(file_csv)
-
-	for row in file_csv:
-		quay_id = row['stop_id'][9:]
+	for stop_id in nsr_gtfs.scan_stop_ids(zip_file, gtfs_workers):
+		quay_id = stop_id[9:]
 		route_quays.add(quay_id)
 
-	file.close()
-	in_file.close()
+	zip_file.close()
 
 
 
-# Load date of last route assignment for all quays
+# Open history database, and import history from JSON file when the database is created.
+# Table columns:
+# - section:	"stations" or "quays"
+# - ref:		NSR station or quay reference
+# - lon, lat:	NSR location at last run
+# - date:		Last date the quay was used by a route (ISO format), or NULL
+
+def open_history():
+
+	global history_db
+
+	file_path = os.path.expanduser(history_filename)
+	new_database = not os.path.isfile(file_path)
+
+	history_db = sqlite3.connect(file_path)
+	history_db.execute("CREATE TABLE IF NOT EXISTS history (section TEXT NOT NULL, ref TEXT NOT NULL, lon REAL, lat REAL, date TEXT, "
+						"PRIMARY KEY (section, ref)) WITHOUT ROWID")
+	history_db.execute("CREATE INDEX IF NOT EXISTS history_date ON history (section, date)")
+
+	json_path = os.path.expanduser(history_json_filename)
+	if new_database and os.path.isfile(json_path):
+		file = open(json_path)
+		json_history = json.load(file)
+		file.close()
+
+		rows = []
+		for section in ["stations", "quays"]:
+			for ref, entry in iter(json_history.get(section, {}).items()):
+				point = entry.get('point', (None, None))
+				rows.append((section, ref, point[0], point[1], entry.get('date')))
+
+		with history_db:
+			history_db.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?)", rows)
+		message ("Imported %i stations/quays from history file '%s'\n" % (len(rows), history_json_filename))
+
+
+
+# Load location and date of last route assignment for all quays, and state of matched stops at last run
 
 def load_history():
 
 	global history
 
-	file_path = os.path.expanduser(history_filename)
+	open_history()
+
+	history = {'stations': {}, 'quays': {}}
+	for section, ref, lon, lat, date in history_db.execute("SELECT section, ref, lon, lat, date FROM history"):
+		entry = {}
+		if lon is not None:
+			entry['point'] = (lon, lat)
+		if date is not None:
+			entry['date'] = date
+		history[ section ][ ref ] = entry
+
+	message ("Loaded quay history\n")
+
+	file_path = os.path.expanduser(state_filename)
 	if os.path.isfile(file_path):
 		file = open(file_path)
-		history = json.load(file)
+		match_state.update(json.load(file))
 		file.close()
-		message ("Loaded quay history\n")
+
+
+
+# Get set of quays with last route assignment before or after a cutoff date.
+# Parameters:
+# - cutoff:		Date in ISO format
+# - before:		True to get quays used on or before cutoff date, False to get quays used after cutoff date
+
+def query_quay_dates (cutoff, before):
+
+	if before:
+		query = "SELECT ref FROM history WHERE section = 'quays' AND date <= ?"
 	else:
-		message ("Quay history '%s' not found\n" % file_path)
+		query = "SELECT ref FROM history WHERE section = 'quays' AND date > ?"
+	return set(ref for (ref,) in history_db.execute(query, (cutoff,)))
 
 
 
@@ -698,320 +1450,624 @@ def load_history():
 
 def save_history(save_file):
 
-	global new_history
+	global history_points, history_dates
 
 	if not save_file:
-		# Part 1: Update all stations and quays with the current NSR location + today's date for quays with an active route
-
-		new_history = copy.deepcopy(history)
+		# Part 1: Find stations and quays with a new NSR location + quays with an active route which did not have today's date
 
-		for ref, station in iter(stations.items()):
-			if ref not in history['stations']:
-				new_history['stations'][ ref ] = {}
-			new_history['stations'][ ref ]['point'] = ( station['lon'], station['lat'] )
-
-		for ref, quay in iter(quays.items()):
-			if ref not in new_history['quays']:
-				new_history['quays'][ ref ] = {}
-			new_history['quays'][ ref ]['point'] = ( quay['lon'], quay['lat'] )
+		history_points = []
+		for section, nsr_stops in [("stations", stations), ("quays", quays)]:
+			for ref, nsr_stop in iter(nsr_stops.items()):
+				point = ( nsr_stop['lon'], nsr_stop['lat'] )
+				if ref not in history[ section ] or history[ section ][ ref ].get('point') != point:
+					history_points.append((section, ref, point[0], point[1]))
 
+		history_dates = []
 		for ref in route_quays:
-			if ref not in new_history['quays']:
-				new_history['quays'][ ref ] = {}
-			new_history['quays'][ ref ]['date'] = today
+			if ref not in history['quays'] or history['quays'][ ref ].get('date') != today:
+				history_dates.append(("quays", ref, today))
 
 	else:
-		# Part 2: Save history file
+		# Part 2: Update history database in one transaction, and save state of matched stops
+
+		with history_db:
+			history_db.executemany("INSERT INTO history (section, ref, lon, lat) VALUES (?, ?, ?, ?) "
+									"ON CONFLICT (section, ref) DO UPDATE SET lon = excluded.lon, lat = excluded.lat", history_points)
+			history_db.executemany("INSERT INTO history (section, ref, date) VALUES (?, ?, ?) "
+									"ON CONFLICT (section, ref) DO UPDATE SET date = excluded.date", history_dates)
+		message ("Saved quay history to '%s' (%i locations, %i dates updated)\n" % (history_filename, len(history_points), len(history_dates)))
 
-		file_path = os.path.expanduser(history_filename)
-		file = open(file_path, "w")
-		json.dump(new_history, file, indent=1)
+		file = open(os.path.expanduser(state_filename), "w")
+		json.dump(new_match_state, file)
 		file.close()
-		message ("Saved quay history to '%s'\n" % history_filename)
 
 
 
-# Read all NSR data into memory from Entur NeTEx file and convert to OSM tags
-# The stations and quay dicts will contain all bus stations and bus stops, respectively
+# Export history database to JSON file, in the same format as the history file which was imported
 
-def load_nsr_data():
+def export_history():
 
-	url = "https://storage.googleapis.com/marduk-production/tiamat/Current_latest.zip"
+	open_history()
+
+	json_history = {'stations': {}, 'quays': {}}
+	for section, ref, lon, lat, date in history_db.execute("SELECT section, ref, lon, lat, date FROM history ORDER BY section, ref"):
+		entry = {}
+		if lon is not None:
+			entry['point'] = (lon, lat)
+		if date is not None:
+			entry['date'] = date
+		json_history[ section ][ ref ] = entry
+
+	file = open(os.path.expanduser(history_json_filename), "w")
+	json.dump(json_history, file, indent=1)
+	file.close()
+	message ("Exported %i stations, %i quays to '%s'\n" % (len(json_history['stations']), len(json_history['quays']), history_json_filename))
+
+
+
+# Extract bus station and bus stops from NSR stop place (see nsr_netex.parse_stop_place) and convert to OSM tags.
+# The result does not depend on routes or history, so it may be kept in the snapshot for the next run.
+# Returns None if the stop place is not a bus station or bus stop in Norway, else dict with:
+# - stop_type:	"busStation" or "onstreetBus"
+# - station:	[ NSR ref, entry ] for bus station, or None
+# - quays:		List of [ NSR ref, entry ] for quays
+
+def extract_bus_stops (stop_place):
+
+	stop_type = stop_place['stop_type']
+	municipality = stop_place['municipality']
+
+	# Only keep bus stops in Norway
+
+	if stop_type not in ["busStation", "onstreetBus"] or not municipality:
+		return None
+
+	name = stop_place['name']
+	transport_submode = stop_place['submode']
+
+	# Only keep stops which are not temporary
+
+	if transport_submode == "railReplacementBus":
+		return None
+
+	record = {
+		'stop_type': stop_type,
+		'station': None,
+		'quays': []
+	}
+
+	# Get comments in NSR if any (for information to mapper only)
+
+	note = ""
+
+	for key_name, key_value in stop_place['keys']:
+		if key_name:
+			if key_name.find("name") > 0:
+				note += ";[" + key_value + "]"
+			elif key_name.find("comment") > 0:
+				if key_value:
+					note += " " + key_value.replace("&lt;", "<")
+
+	note = note.lstrip(";")
+
+	# Get bus station
+
+	if stop_type == "busStation":
+
+		entry = {
+			'name': name,
+			'lon': float(stop_place['lon']),
+			'lat': float(stop_place['lat']),
+			'municipality': municipality,
+			'version': stop_place['version'],
+		}
+
+		if transport_submode:
+			entry['submode'] = transport_submode
+		if note:
+			entry['nsrnote'] = note
+
+		record['station'] = [ stop_place['ref'], entry ]
+
+	# Avoid single quays for bus stations
+
+	quay_data = stop_place['quays']
+
+	if stop_type == "busStation" and len(quay_data) == 1:
+		quay_data = []
+
+	# Get quay nodes
+
+	for quay in quay_data:
+
+		ref = quay['public_code'] or ""
+
+		# Use quay reference for bus stations + add station name in official_name
+		# Else use stop name if not station
+		# Add public reference number/letter, if any, in parenteces in name (it is displayed on the quay)
+
+		entry = {
+			'lon': float(quay['lon']),
+			'lat': float(quay['lat']),
+			'municipality': municipality,
+			'stoptype': stop_type,
+			'version': quay['version']
+		}
+
+		if stop_type == "busStation":
+			if ref:
+				entry['name'] = ref
+				entry['official_name'] = name + " (" + ref + ")"
+				entry['ref'] = ref
+			else:
+				entry['official_name'] = name
+				ref = quay['private_code']
+				if ref:
+					entry['unsigned_ref'] = ref
+		else:
+			if ref:
+				entry['name'] = name + " (" + ref + ")"
+				entry['ref'] = ref
+			else:
+				entry['name'] = name
+
+			if transport_submode:
+				entry['submode'] = transport_submode
+			if note:
+				entry['nsrnote'] = note
+
+		record['quays'].append([ quay['ref'], entry ])
+
+	return record
+
+
+
+# Open snapshot database of NSR stop places at last run, and return version of NeTEx feed at last run (or None).
+# The snapshot is emptied if it was saved in another format.
+# Tables:
+# - stop_places:	NSR stop place reference, position in NeTEx file, version, and bus stops as JSON (see extract_bus_stops)
+#					or NULL if not a bus stop. All stop places are included, to report changes since last run.
+# - feed:			Key/value pairs for 'format' (snapshot_format) and 'version' (see nsr_feeds.feed_version)
+
+def open_snapshot():
+
+	global snapshot_db
+
+	file_path = os.path.expanduser(snapshot_filename)
+	os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+	snapshot_db = sqlite3.connect(file_path)
+	snapshot_db.execute("CREATE TABLE IF NOT EXISTS stop_places (ref TEXT NOT NULL PRIMARY KEY, position INTEGER NOT NULL, "
+						"version TEXT, record TEXT) WITHOUT ROWID")
+	snapshot_db.execute("CREATE TABLE IF NOT EXISTS feed (key TEXT NOT NULL PRIMARY KEY, value TEXT) WITHOUT ROWID")
+
+	feed = dict(snapshot_db.execute("SELECT key, value FROM feed"))
+	if feed.get('format') != snapshot_format:
+		with snapshot_db:
+			snapshot_db.execute("DELETE FROM stop_places")
+			snapshot_db.execute("DELETE FROM feed")
+			snapshot_db.execute("INSERT INTO feed VALUES ('format', ?)", (snapshot_format,))
+		return None
+
+	return feed.get('version')
+
+
+
+# Iterate bus stations and bus stops in NSR (see extract_bus_stops), in NeTEx file order.
+# If the NeTEx feed has the same version as at the last run, the bus stops are read from the snapshot without parsing the feed.
+# Otherwise the feed is parsed, and only new, changed and removed stop places are updated in the snapshot.
+# New, changed and removed stop places since last run are recorded in stop_place_changes.
+
+def iter_bus_stops (zip_file, feed_version):
+
+	for change in ["new", "changed", "removed"]:
+		stop_place_changes[ change ] = []
+
+	snapshot_version = None
+	if snapshot_filename:
+		snapshot_version = open_snapshot()
+
+		if feed_version is not None and feed_version == snapshot_version:
+			for (record,) in snapshot_db.execute("SELECT record FROM stop_places WHERE record IS NOT NULL ORDER BY position"):
+				yield json.loads(record)
+			message ("NSR feed not changed since last run, bus stops loaded from snapshot\n")
+			return
+
+		last_stop_places = {}  # NSR ref -> (position, version) at last run
+		for ref, position, version in snapshot_db.execute("SELECT ref, position, version FROM stop_places"):
+			last_stop_places[ ref ] = (position, version)
+		previous_snapshot = bool(last_stop_places)
+
+	# Iterate all stops, one StopPlace at a time
+
+	updates = []  # Rows for new and changed stop places
+	moves = []  # New positions of unchanged stop places
 
-	in_file = urllib.request.urlopen(url)
-	zip_file = zipfile.ZipFile(BytesIO(in_file.read()))
 	filename = zip_file.namelist()[0]
 	file = zip_file.open(filename)
 
-	tree = ET.parse(file)
+	for position, stop_place in enumerate(nsr_netex.iter_stops(file)):
+		record = extract_bus_stops(stop_place)
+
+		if snapshot_filename:
+			ref = stop_place['ref']
+			last = last_stop_places.pop(ref, None)
+			if last is None or last[1] != stop_place['version']:
+				stop_place_changes[ "new" if last is None else "changed" ].append(ref)
+				if record is not None:
+					updates.append((ref, position, stop_place['version'], json.dumps(record, ensure_ascii=False, separators=(",", ":"))))
+				else:
+					updates.append((ref, position, stop_place['version'], None))
+			elif last[0] != position:
+				moves.append((position, ref))
+
+		if record is not None:
+			yield record
+
 	file.close()
-	root = tree.getroot()
 
-	ns_url = 'http://www.netex.org.uk/netex'
-	ns = {'ns0': ns_url}  # Namespace
+	if not snapshot_filename:
+		return
+
+	# Update snapshot in one transaction, including version of feed
+
+	stop_place_changes['removed'] = list(last_stop_places)
+
+	with snapshot_db:
+		snapshot_db.executemany("INSERT OR REPLACE INTO stop_places VALUES (?, ?, ?, ?)", updates)
+		snapshot_db.executemany("UPDATE stop_places SET position = ? WHERE ref = ?", moves)
+		snapshot_db.executemany("DELETE FROM stop_places WHERE ref = ?", [ (ref,) for ref in stop_place_changes['removed'] ])
+		snapshot_db.execute("INSERT OR REPLACE INTO feed VALUES ('version', ?)", (feed_version,))
+
+	if previous_snapshot:
+		message ("%i new, %i changed and %i removed stop places in NSR since last run\n"
+					% (len(stop_place_changes['new']), len(stop_place_changes['changed']), len(stop_place_changes['removed'])))
+	else:
+		stop_place_changes['new'] = []  # Do not report all stops as new
+
+
+
+# Read all NSR data into memory from Entur NeTEx file and convert to OSM tags
+# The stations and quay dicts will contain all bus stations and bus stops, respectively
+# The county_stations and county_quays dicts contain the same stops, partitioned by county
+
+def load_nsr_data():
+
+	url = "https://storage.googleapis.com/marduk-production/tiamat/Current_latest.zip"
 
-	stop_data = root.find("ns0:dataObjects/ns0:SiteFrame/ns0:stopPlaces", ns)
+	zip_file = nsr_feeds.open_feed(url)
 
 	station_count = 0
 	quay_count = 0
 	keep_one_year_count = 0
 	exclude_one_year_count = 0
 
-	# Iterate all stops
+	cutoff = (datetime.date.today() - datetime.timedelta(days=365)).isoformat()
+	recent_quays = query_quay_dates(cutoff, before=False)  # Used by a route less than one year ago
+	expired_quays = query_quay_dates(cutoff, before=True)  # Not used by any route last year
 
-	for stop_place in stop_data.iter('{%s}StopPlace' % ns_url):
+	# Iterate all bus stations and bus stops, one StopPlace at a time
+	# The NeTEx feed is not parsed if it has not changed since the last run
 
-		stop_type = stop_place.find('ns0:StopPlaceType', ns)
-		if stop_type != None:
-			stop_type = stop_type.text
-		else:
-			stop_type = ""
+	for record in iter_bus_stops(zip_file, nsr_feeds.feed_version(url)):
 
-		municipality = stop_place.find('ns0:TopographicPlaceRef', ns)
-		if municipality != None:
-			municipality = municipality.get('ref')
-			if municipality[0:3] == "KVE":
-				municipality = municipality.replace("KVE:TopographicPlace:", "")
-			else:
-				municipality = ""
-		else:
-			municipality = ""
+		stop_type = record['stop_type']
 
-		# Only keep bus stops in Norway
+		if record['station'] is not None:
+			station_count += 1
+			nsr_ref, entry = record['station']
+			stations[ nsr_ref ] = entry
 
-		if stop_type in ["busStation", "onstreetBus"] and municipality:
+		for nsr_ref, entry in record['quays']:
 
-			name = stop_place.find('ns0:Name', ns)
-			if name != None:
-				name = name.text
-			else:
-				name = ""
-			name = name.replace("  ", " ").strip()
+			quay_count -= 1
 
-			transport_mode = stop_place.find('ns0:TransportMode', ns)
-			if transport_mode != None:
-				transport_mode = transport_mode.text
-			else:
-				transport_mode = ""
+			# Omit quays which have not had a route last year, unless they belong to a bus station
 
-			if transport_mode:
-				transport_submode = stop_place.find('ns0:%sSubmode' % transport_mode.title(), ns)
-				if transport_submode != None:
-					transport_submode = transport_submode.text
-				else:
-					transport_submode = ""
-			else:
-				transport_submode = ""
+			if stop_type == "busStation" or nsr_ref in route_quays or nsr_ref in recent_quays:
+				quays[ nsr_ref ] = entry
 
-			# Only keep stops which are not temporary
+			if stop_type != "busStation" and nsr_ref not in route_quays:
+				if nsr_ref in expired_quays:
+#					message ("\tExcluded quay %s\n" % nsr_ref)
+					exclude_one_year_count += 1
+				elif nsr_ref in recent_quays:
+					keep_one_year_count += 1
 
-			if transport_submode != "railReplacementBus":
+	zip_file.close()
 
-				# Get comments in NSR if any (for information to mapper only)
+	# Partition stations and quays by county, so that each county only needs to visit its own stops
 
-				note = ""
-				key_list = stop_place.find('ns0:keyList', ns)
+	for nsr_stops, county_stops in [(stations, county_stations), (quays, county_quays)]:
+		for nsr_ref, entry in iter(nsr_stops.items()):
+			county_id = entry['municipality'][0:2]
+			if county_id not in county_stops:
+				county_stops[ county_id ] = {}
+			county_stops[ county_id ][ nsr_ref ] = entry
 
-				if key_list != None:
-					for key in key_list.iter('{%s}KeyValue' % ns_url):
-						key_name = key.find('ns0:Key', ns).text
-						key_value = key.find('ns0:Value', ns).text
-						if key_name:
-							if key_name.find("name") > 0:
-								note += ";[" + key_value + "]"
-							elif key_name.find("comment") > 0:
-								if key_value:
-									note += " " + key_value.replace("&lt;", "<")
+	message ("%i kept up to one year, %i excluded after one year\n" % (keep_one_year_count, exclude_one_year_count))
 
-				note = note.lstrip(";")
 
-				# Get bus station
 
-				if stop_type == "busStation":
+# Plan upload of spooled elements in changesets, grouped by county and ordered by tile within each county.
+# Each changeset has at most changeset_size elements. Elements in the same group are kept in the same changeset.
+# The plan is saved as upload progress, so that an interrupted upload may be resumed with -resume.
 
-					station_count  += 1
+def plan_upload():
 
-					location = stop_place.find('ns0:Centroid/ns0:Location', ns)
-					longitude = float(location.find('ns0:Longitude', ns).text)
-					latitude = float(location.find('ns0:Latitude', ns).text)
+	counties = {}  # County id -> list of (tile row, tile column, first index, group)
+	groups = {}  # Group -> list of indexes
+	file = open(out_filename + "_upload.jsonl", encoding="utf-8")
+	for index, line in enumerate(file):
+		record = json.loads(line)
+		if record['group'] not in groups:
+			groups[ record['group'] ] = []
+			if record['county'] not in counties:
+				counties[ record['county'] ] = []
+			counties[ record['county'] ].append((record['tile'][1], record['tile'][0], index, record['group']))
+		groups[ record['group'] ].append(index)
+	file.close()
 
-					nsr_ref = stop_place.get('id').replace("NSR:StopPlace:", "")
+	chunks = []
+	for county_id in sorted(counties):
+		chunk = []
+		for row, column, first_index, group in sorted(counties[ county_id ]):
+			if chunk and len(chunk) + len(groups[ group ]) > changeset_size:
+				chunks.append(chunk)
+				chunk = []
+			chunk.extend(groups[ group ])
+		if chunk:
+			chunks.append(chunk)
 
-					entry = {
-						'name': name,
-						'lon': longitude,
-						'lat': latitude,
-						'municipality': municipality,
-						'version': stop_place.get('version'),
-					}
+	progress = {
+		'chunks': chunks,
+		'done': 0,
+		'changesets': [],
+		'pending': None  # Changeset created for next chunk, until the upload has been confirmed
+	}
+	save_progress(progress)
+	return progress
 
-					if transport_submode:
-						entry['submode'] = transport_submode
-					if note:
-						entry['nsrnote'] = note
 
-					stations[ nsr_ref ] = entry
 
-				# Avoid single quays for bus stations
+# Save upload progress, replacing the previous file only when the new file is complete
 
-				quay_data = stop_place.find('ns0:quays', ns)
+def save_progress (progress):
 
-				if quay_data != None and stop_type == "busStation":
-					count = 0
-					for quay in quay_data.iter('{%s}Quay' % ns_url):
-						count += 1
-					if count == 1:
-						quay_data = None
+	file_path = out_filename + "_upload_progress.json"
+	file = open(file_path + ".part", "w")
+	json.dump(progress, file)
+	file.close()
+	os.replace(file_path + ".part", file_path)
 
-				# Get quay nodes
 
-				if quay_data != None:
-					for quay in quay_data.iter('{%s}Quay' % ns_url):
 
-						quay_count -= 1
+# Load upload progress, or None if there is no unfinished upload
 
-						location = quay.find('ns0:Centroid/ns0:Location', ns)
-						longitude = float(location.find('ns0:Longitude', ns).text)
-						latitude = float(location.find('ns0:Latitude', ns).text)
+def load_progress():
 
-						public_code = quay.find('ns0:PublicCode', ns)
-						if public_code != None:
-							ref = public_code.text
-						else:
-							ref = ""
-
-						# Use quay reference for bus stations + add station name in official_name
-						# Else use stop name if not station
-						# Add public reference number/letter, if any, in parenteces in name (it is displayed on the quay)
-
-						entry = {
-							'lon': longitude,
-							'lat': latitude,
-							'municipality': municipality,
-							'stoptype': stop_type,
-							'version': quay.get('version')
-						}
-
-						if stop_type == "busStation":
-							if ref:
-								entry['name'] = ref
-								entry['official_name'] = name + " (" + ref + ")"
-								entry['ref'] = ref
-							else:
-								entry['official_name'] = name
-								private_code = quay.find('ns0:PrivateCode', ns)
-								if private_code != None:
-									ref = private_code.text
-									if ref:
-										entry['unsigned_ref'] = ref
-						else:
-							if ref:
-								entry['name'] = name + " (" + ref + ")"
-								entry['ref'] = ref
-							else:
-								entry['name'] = name
-
-							if transport_submode:
-								entry['submode'] = transport_submode
-							if note:
-								entry['nsrnote'] = note
-
-						nsr_ref = quay.get('id').replace("NSR:Quay:", "")
-
-						# Omit quays which have not had a route last year, unless they belong to a bus station
-
-						if (stop_type == "busStation"
-								or nsr_ref in route_quays
-								or nsr_ref in history['quays']
-									and "date" in history['quays'][ nsr_ref ]
-									and (datetime.date.today() - datetime.date.fromisoformat(history['quays'][ nsr_ref ]['date'])).days < 365):
-							quays[ nsr_ref ] = entry
-
-						if (stop_type != "busStation"
-								and nsr_ref not in route_quays
-								and nsr_ref in history['quays']
-								and "date" in history['quays'][ nsr_ref ]):
-							if (datetime.date.today() - datetime.date.fromisoformat(history['quays'][ nsr_ref ]['date'])).days >= 365:
-#								message ("\tExcluded quay %s\n" % nsr_ref)
-								exclude_one_year_count += 1
-							else:
-								keep_one_year_count += 1
+	file_path = out_filename + "_upload_progress.json"
+	if not os.path.isfile(file_path) or not os.path.isfile(out_filename + "_upload.jsonl"):
+		return None
 
-	message ("%i kept up to one year, %i excluded after one year\n" % (keep_one_year_count, exclude_one_year_count))
+	file = open(file_path)
+	progress = json.load(file)
+	file.close()
+	return progress
 
 
 
-# Upload changeset to OSM
+# Fetch current version, user and visibility of given elements from OSM, in one multi-fetch request.
+# If any element does not exist (404), the request is split until the missing elements are found.
+# Returns dict of id -> (version, user, visible), without missing elements.
 
-def upload_changeset():
+def fetch_versions (element_type, ids):
 
-	if upload and stops_total_changes > 0:
+	request = urllib.request.Request(osm_api + "%ss?%ss=%s" % (element_type, element_type, ",".join(str(ref) for ref in ids)),
+										headers=osm_request_header)
+	try:
+		file = open_url(request)
+	except urllib.error.HTTPError as e:
+		if e.code != 404:
+			raise
+		if len(ids) == 1:
+			return {}
+		versions = fetch_versions(element_type, ids[ : len(ids) // 2 ])
+		versions.update(fetch_versions(element_type, ids[ len(ids) // 2 : ]))
+		return versions
+
+	root = ET.fromstring(file.read())
+	file.close()
 
-		if stops_total_changes < 9900:  # Maximum upload is 10.000 elements
-			
-			today_date = time.strftime("%Y-%m-%d", time.localtime())
+	versions = {}
+	for element in root.iter(element_type):
+		versions[ int(element.get("id")) ] = (int(element.get("version")), element.get("user", ""), element.get("visible", "true") == "true")
+	return versions
+
+
+
+# Check versions of modified and deleted elements against OSM before upload, as Overpass may lag behind the OSM API.
+# Elements with a newer version in OSM are rebased to the newer version only if it was made by the import user itself,
+# otherwise dropped from the upload (they will be considered again at the next run), so that edits by others are kept.
+# Elements already deleted in OSM are dropped. Other elements in the same group as a dropped element are also dropped.
+# Returns set of indexes of dropped records. Rebased records are updated in place.
+
+def check_versions (records, indexes):
+
+	elements = {}
+	for index in indexes:
+		record = records[ index ]
+		if record['action'] in ["modify", "delete"]:
+			if record['type'] not in elements:
+				elements[ record['type'] ] = []
+			elements[ record['type'] ].append(index)
+
+	message ("Checking current versions of %i elements in OSM... " % sum(len(type_indexes) for type_indexes in elements.values()))
+
+	dropped = set()
+	rebased = 0
+	conflicts = []
+
+	for element_type, type_indexes in iter(elements.items()):
+		for start in range(0, len(type_indexes), version_batch):
+			batch = type_indexes[ start : start + version_batch ]
+			versions = fetch_versions(element_type, [ records[ index ]['id'] for index in batch ])
+
+			for index in batch:
+				record = records[ index ]
+				if record['id'] not in versions:
+					dropped.add(index)
+					conflicts.append("%s %i not found in OSM" % (record['type'], record['id']))
+					continue
+
+				version, user, visible = versions[ record['id'] ]
+				if not visible:
+					dropped.add(index)
+					conflicts.append("%s %i already deleted in OSM (version %i by %s)" % (record['type'], record['id'], version, user))
+
+				elif version != record['version']:
+					if user == username:
+						record['xml'] = record['xml'].replace(' version="%i"' % record['version'], ' version="%i"' % version, 1)
+						record['version'] = version
+						rebased += 1
+					else:
+						dropped.add(index)
+						conflicts.append("%s %i edited in OSM (version %i by %s)" % (record['type'], record['id'], version, user))
 
-			changeset_root = ET.Element("osm")
-			changeset_element = ET.Element("changeset")
-			changeset_element.append(ET.Element("tag", k="comment", v="Bus stop import update for Norway"))
-			changeset_element.append(ET.Element("tag", k="source", v="Entur: Norsk Stoppestedsregister (NSR)"))			
-			changeset_element.append(ET.Element("tag", k="source:date", v=today_date))
-			changeset_root.append(changeset_element)
-			changeset_xml = ET.tostring(changeset_root, encoding='utf-8', method='xml')
+	# Drop whole groups
 
-			request = urllib.request.Request(osm_api + "changeset/create", data=changeset_xml, headers=osm_request_header, method="PUT")
-			file = open_url(request)  # Create changeset
-			changeset_id = file.read().decode()
-			file.close()	
+	dropped_groups = set(records[ index ].get('group', None) for index in dropped)
+	for index in indexes:
+		record = records[ index ]
+		if index not in dropped and record.get('group', None) in dropped_groups:
+			dropped.add(index)
+			conflicts.append("%s %i together with %s" % (record['type'], record['id'], record['group'].replace("/", " ")))
 
-			message ("\nUploading %i elements to OSM in changeset #%s..." % (stops_total_changes, changeset_id))
+	message ("%i rebased, %i dropped\n" % (rebased, len(dropped)))
+	for conflict in conflicts:
+		message ("  Dropped %s\n" % conflict)
 
-			for element in upload_root:
-				element[0].set("changeset", changeset_id)
-				for tag in element[0].findall("tag"):
-					if tag.attrib['k'] in manual_keys:  # Remove import keys
-						element[0].remove(tag)
+	return dropped
 
-			indent_tree(upload_root)
-			changeset_xml = ET.tostring(upload_root, encoding='utf-8', method='xml')
 
-			request = urllib.request.Request(osm_api + "changeset/%s/upload" % changeset_id, data=changeset_xml, headers=osm_request_header)
-			file = open_url(request)  # Post changeset in one go
-			file.close()
 
-			request = urllib.request.Request(osm_api + "changeset/%s/close" % changeset_id, headers=osm_request_header, method="PUT")
-			file = open_url(request)  # Close changeset
-			file.close()
+# Close changeset in OSM
 
-			if debug:
-				file_out = open("nsr_changeset.xml", "w")
-				file_out.write(changeset_xml.decode())
-				file_out.close()
+def close_changeset (changeset_id):
 
-			message ("\nDone\n\n")
+	request = urllib.request.Request(osm_api + "changeset/%s/close" % changeset_id, headers=osm_request_header, method="PUT")
+	file = open_url(request)
+	file.close()
 
-		else:
-			message ("\n\nCHANGESET TOO LARGE (%i) - UPLOAD MANUALLY WITH JOSM\n\n" % stops_total_changes)
 
 
+# Check changeset which was created for the next chunk, but not confirmed as uploaded when the upload was interrupted.
+# Uploads are atomic, so the chunk has been uploaded if the changeset contains any changes.
+# The changeset is closed if it is still open.
 
-# Insert line feeds into XLM file.
+def check_pending_changeset (progress):
 
-def indent_tree(elem, level=0):
+	changeset_id = progress.get('pending', None)
+	if not changeset_id:
+		return
+
+	request = urllib.request.Request(osm_api + "changeset/%s" % changeset_id, headers=osm_request_header)
+	file = open_url(request)
+	changeset = ET.fromstring(file.read()).find("changeset")
+	file.close()
 
-	i = "\n" + level*"  "
-	if len(elem):
-		if not elem.text or not elem.text.strip():
-			elem.text = i + "  "
-		if not elem.tail or not elem.tail.strip():
-			elem.tail = i
-		for elem in elem:
-			indent_tree(elem, level+1)
-		if not elem.tail or not elem.tail.strip():
-			elem.tail = i
+	if int(changeset.get("changes_count", "0")) > 0:
+		message ("Changeset #%s was uploaded before interruption\n" % changeset_id)
+		progress['done'] += 1
+		progress['changesets'].append(changeset_id)
 	else:
-		if level and (not elem.tail or not elem.tail.strip()):
-			elem.tail = i
+		message ("Changeset #%s was not uploaded before interruption, uploading again\n" % changeset_id)
+
+	progress['pending'] = None
+	save_progress(progress)
+
+	if changeset.get("open") == "true":
+		close_changeset(changeset_id)
+
+
+
+# Upload changesets to OSM according to upload progress, starting with first changeset not yet uploaded.
+# The changeset id is saved before each upload, so that a resumed upload will not upload the same chunk twice.
+# Progress is saved after each changeset. Spool and progress files are removed when all changesets are uploaded.
+
+def upload_changesets (progress):
+
+	file = open(out_filename + "_upload.jsonl", encoding="utf-8")
+	records = [ json.loads(line) for line in file ]
+	file.close()
+
+	total = len(progress['chunks'])
+	message ("\nUploading %i elements to OSM in %i changesets...\n" % (sum(len(chunk) for chunk in progress['chunks']), total))
+	if progress['done'] > 0:
+		message ("Resuming after %i uploaded changesets\n" % progress['done'])
+	check_pending_changeset(progress)
+
+	dropped = check_versions(records, [ index for chunk in progress['chunks'][ progress['done'] : ] for index in chunk ])
+
+	today_date = time.strftime("%Y-%m-%d", time.localtime())
+
+	while progress['done'] < total:
+		chunk = [ index for index in progress['chunks'][ progress['done'] ] if index not in dropped ]
+
+		if not chunk:  # All elements dropped
+			progress['done'] += 1
+			save_progress(progress)
+			continue
+
+		changeset_root = ET.Element("osm")
+		changeset_element = ET.Element("changeset")
+		changeset_element.append(ET.Element("tag", k="comment", v="Bus stop import update for Norway"))
+		changeset_element.append(ET.Element("tag", k="source", v="Entur: Norsk Stoppestedsregister (NSR)"))			
+		changeset_element.append(ET.Element("tag", k="source:date", v=today_date))
+		changeset_root.append(changeset_element)
+		changeset_xml = ET.tostring(changeset_root, encoding='utf-8', method='xml')
+
+		request = urllib.request.Request(osm_api + "changeset/create", data=changeset_xml, headers=osm_request_header, method="PUT")
+		file = open_url(request)  # Create changeset
+		changeset_id = file.read().decode()
+		file.close()	
+
+		progress['pending'] = changeset_id
+		save_progress(progress)
+
+		message ("  Changeset #%s: %i elements in county %s (%i of %i)\n"
+					% (changeset_id, len(chunk), records[ chunk[0] ]['county'], progress['done'] + 1, total))
+
+		lines = [ '<osmChange version="0.6" generator="nsr2osm">\n' ]
+		for index in chunk:
+			record = records[ index ]
+			lines.append("  <%s>\n" % record['action'])
+			lines.append(record['xml'])
+			lines.append("  </%s>\n" % record['action'])
+		lines.append("</osmChange>\n")
+		changeset_xml = "".join(lines).replace(' changeset="0"', ' changeset="%s"' % changeset_id).encode("utf-8")
+
+		request = urllib.request.Request(osm_api + "changeset/%s/upload" % changeset_id, data=changeset_xml, headers=osm_request_header)
+		file = open_url(request)  # Post changeset in one go
+		file.close()
+
+		progress['done'] += 1
+		progress['changesets'].append(changeset_id)
+		progress['pending'] = None
+		save_progress(progress)
+
+		close_changeset(changeset_id)
+
+		if debug:
+			file_out = open("nsr_changeset_%i.xml" % progress['done'], "w")
+			file_out.write(changeset_xml.decode())
+			file_out.close()
+
+	os.remove(out_filename + "_upload_progress.json")
+	os.remove(out_filename + "_upload.jsonl")
+
+	message ("Done\n\n")
+
 
 
 # Get authorization for later uploading to OSM.
@@ -1024,8 +2080,8 @@ def get_password():
 
 	authorization = username.strip() + ":" + password.strip()
 	authorization = "Basic " + base64.b64encode(authorization.encode()).decode()
-	osm_request_header = request_header
-	osm_request_header.update({'Authorization': authorization})
+	osm_request_header = dict(request_header)  # Authorization only for OSM API requests
+	osm_request_header['Authorization'] = authorization
 
 	request = urllib.request.Request(osm_api + "permissions", headers=osm_request_header)
 	file = open_url(request)
@@ -1047,12 +2103,22 @@ if __name__ == '__main__':
 
 	stations = {}
 	quays = {}
+	county_stations = {}  # Same stations, partitioned by two digit county ref
+	county_quays = {}  # Same quays, partitioned by two digit county ref
+	stop_place_changes = {}  # Lists of new, changed and removed NSR stop places since last run
+	suggested_quays = set()  # NSR quays suggested for other stops in OSM, not to be created as new stops
+	nsr_names = {'station': {}, 'quay': {}}  # Normalised name and trigrams for each NSR station and quay
+	name_edits = []  # Names edited by users in current county
 	history = {}
+	history_db = None
+	snapshot_db = None
+	match_state = {}  # State of matched NSR and OSM stops at last run, keyed by match_key
+	new_match_state = {}  # Same for this run, saved together with history
 	route_quays = set()
 	osm_data = {}
-	osm_way_nodes = []
-	osm_relation_members = []
-	osm_ptv2_members = []
+	osm_elements = {}
+	osm_parent_ways = {}
+	osm_parent_relations = {}
 	changeset_data = ""
 
 	message ("\nnsr2osm v%s\n\n" % version)
@@ -1063,12 +2129,29 @@ if __name__ == '__main__':
 		upload = True
 	elif (len(sys.argv) == 2) and (sys.argv[1] == "-manual"):
 		upload = False
+	elif (len(sys.argv) == 2) and (sys.argv[1] == "-resume"):
+		upload = True
+	elif (len(sys.argv) == 2) and (sys.argv[1] == "-export-history"):
+		export_history()
+		sys.exit()
 	else:
-		sys.exit ("Please choose eiter '-upload' or '-manual'")
+		sys.exit ("Please choose eiter '-upload', '-manual', '-resume' or '-export-history'")
 
 	if upload:
 		osm_request_header = get_password()
 
+	# Resume interrupted upload
+
+	if sys.argv[1] == "-resume":
+		progress = load_progress()
+		if progress is None:
+			sys.exit ("No interrupted upload found\n")
+		upload_changesets(progress)
+		sys.exit()
+
+	if upload and load_progress() is not None:
+		sys.exit ("Please finish interrupted upload with '-resume' first\n")
+
 	# Load all stops from NSR
 
 	start_time = time.time()
@@ -1082,6 +2165,7 @@ if __name__ == '__main__':
 
 	message ("Loading NSR bus stops/stations... ")
 	load_nsr_data()
+	build_name_index()
 	message ("%i stations, %i quays\n" % (len(stations), len(quays)))
 
 	save_history(save_file=False)
@@ -1098,8 +2182,13 @@ if __name__ == '__main__':
 
 	# Open output files
 
+	open_osm_files()
+
 	if debug:
 		log_file = open(out_filename + "_log.txt", "w")
+		for change in ["new", "changed", "removed"]:
+			if stop_place_changes[ change ]:
+				log ("%s NSR STOP PLACES SINCE LAST RUN: %s\n" % (change.upper(), ", ".join(stop_place_changes[ change ])))
 
 	stops_total_modify = 0
 	stops_total_delete = 0
@@ -1108,15 +2197,30 @@ if __name__ == '__main__':
 	stops_total_others = 0
 	node_id = -1000
 
-	osm_root = ET.Element("osm", version="0.6", generator="nsr2osm v%s" % version, upload="false")
-	upload_root = ET.Element("osmChange", version="0.6", generator="nsr2osm")
-
 	# Iterate counties to match NSR vs OSM and output result
 
-	for county_id, county_name in sorted(counties.items()):
+	# Overpass downloads are prefetched concurrently in a bounded pool, while matching is done one county at a time in order
 
-		if county_id not in exclude_counties:
-			process_county (county_id, county_name)
+	county_ids = [ county_id for county_id in sorted(counties) if county_id not in exclude_counties ]
+
+	if overpass_national:
+		message ("\nLoading Norway from Overpass... ")
+		county_data = partition_counties(load_norway(), county_ids)
+		message ("%i elements\n" % sum(len(data['elements']) for data in county_data.values()))
+
+		for county_id in county_ids:
+			process_county (county_id, counties[ county_id ], county_data.pop(county_id))
+
+	else:
+		message ("\nLoading %i counties from Overpass, %i at a time...\n" % (len(county_ids), overpass_slots))
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=overpass_slots) as pool:
+			downloads = {}
+			for county_id in county_ids:
+				downloads[ county_id ] = pool.submit(load_county, counties[ county_id ])
+
+			for county_id in county_ids:
+				process_county (county_id, counties[ county_id ], downloads.pop(county_id).result())
 
 	# Output remaining NSR stations and quays which were not found in OSM
 
@@ -1124,9 +2228,7 @@ if __name__ == '__main__':
 
 	# Close files
 
-	osm_tree = ET.ElementTree(osm_root)
-	indent_tree(osm_root)
-	osm_tree.write(out_filename + ".osm", encoding="utf-8", method="xml", xml_declaration=True)
+	close_osm_files()
 
 	if debug:
 		log_file.close()
@@ -1148,8 +2250,9 @@ if __name__ == '__main__':
 	if upload and stops_total_changes > 0:
 		confirm = input ("Please confirm upload of %i stop/station changes to OSM (y/n): " % stops_total_changes)
 		if confirm.lower() == "y":
-			upload_changeset()
-			save_history(save_file=True)
+			progress = plan_upload()
+			save_history(save_file=True)  # Remaining changesets will be uploaded with -resume if interrupted
+			upload_changesets(progress)
 		else:
 			message ("Not uploaded\n")
 
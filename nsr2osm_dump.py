@@ -3,21 +3,42 @@
 
 # nsr2osm_dump
 # Converts public transportation stops from Entur NeTEx and GTFS files to OSM format
-# Usage: stop2osm [county] (or "Norge" to get the whole country)
-# Creates OSM file with name "Stoppested_" + county (or Current for whole country)
+# Usage: stop2osm [county] (or "Norge" to get the whole country) [-gz|-bz2|-zst] [-pbf] [-gpkg] [-diff]
+# Creates OSM file with name "Stoppested_" + county (or Current for whole country), optionally compressed
+# Optionally also creates OSM PBF file and GeoPackage file with the same nodes
+# Optionally also creates osmChange file with the changes since the last dump, using a snapshot of the last dump
 
 
-import html
 import sys
-import zipfile
+import os
 import csv
-from urllib import request
-from io import BytesIO, TextIOWrapper
-from xml.etree import ElementTree
+import json
+import hashlib
+import gzip
+import bz2
+import shutil
+import tempfile
+from io import TextIOWrapper
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+import nsr_export
+import nsr_feeds
+import nsr_gtfs
+import nsr_netex
 
 
 version = "1.0.0"
 
+gtfs_workers = 1  # Number of processes for scanning GTFS stop_times.txt (0 for one per CPU)
+
+output_lines = 50000  # Number of lines collected before writing to output file
+
+escape_table = str.maketrans({'&': "&amp;", '<': "&lt;", '>': "&gt;", '"': "&quot;", "'": "&#x27;"})  # Same as html.escape
+
 filenames = [
 	'Current',  # All of Norway
 	'03_Oslo',
@@ -33,9 +54,6 @@ filenames = [
 	'54_Troms_Finnmark'
 ]
 
-ns_url = 'http://www.netex.org.uk/netex'
-ns = {'ns0': ns_url}  # Namespace
-
 
 
 # Output message
@@ -47,12 +65,154 @@ def message (output_text):
 
 
 
-# Produce a tag for OSM file
+# Produce a tag for current node
 
 def make_osm_line(key,value):
 	if value:
-		escaped_value = html.escape(value).strip()
-		file_out.write ('    <tag k="%s" v="%s" />\n' % (key, escaped_value))
+		node_tags.append((key, value.strip()))
+
+
+
+# Get stable node id for NSR station or quay, derived from NSR ref, so that each stop keeps its id in later dumps
+# Parameter:
+# - stop_key:	"s" + station ref or "q" + quay ref
+
+def get_node_id (stop_key):
+
+	if stop_key[0] == "s":
+		return -2 * int(stop_key[1:])
+	else:
+		return -2 * int(stop_key[1:]) - 1
+
+
+
+# Get OSM XML lines for node with given tags, with given indentation
+
+def node_xml (node_id, lat, lon, tags, indent):
+
+	lines = [ indent + '<node id="%i" lat="%s" lon="%s">\n' % (node_id, lat, lon) ]
+	for key, value in tags:
+		lines.append (indent + '  <tag k="' + key + '" v="' + value.translate(escape_table) + '" />\n')
+	lines.append (indent + '</node>\n')
+	return lines
+
+
+
+# Produce current node with collected tags for OSM file, and for PBF and GeoPackage files if selected.
+# If a diff is produced, the node is compared with the snapshot of the last dump.
+# Parameter:
+# - stop_key:	"s" + station ref or "q" + quay ref
+
+def make_osm_node (stop_key, lat, lon):
+
+	node_id = get_node_id(stop_key)
+
+	output.extend (node_xml(node_id, lat, lon, node_tags, "  "))
+	flush_output()
+
+	if pbf_file:
+		nsr_export.write_pbf_node(pbf_file, node_id, float(lat), float(lon), list(node_tags))
+	if gpkg_file:
+		nsr_export.write_gpkg_node(gpkg_file, node_id, float(lat), float(lon), node_tags)
+
+	if snapshot is not None:
+		digest = hashlib.md5(repr((lat, lon, node_tags)).encode()).hexdigest()[:16]
+		new_snapshot[ stop_key ] = [ dict(node_tags).get("VERSION", ""), digest, lat, lon ]
+		if stop_key not in snapshot:
+			diff_files['create'].writelines (node_xml(node_id, lat, lon, node_tags, "    "))
+			diff_count['create'] += 1
+		elif snapshot[ stop_key ][1] != digest:
+			diff_files['modify'].writelines (node_xml(node_id, lat, lon, node_tags, "    "))
+			diff_count['modify'] += 1
+
+	del node_tags[:]
+
+
+
+# Load snapshot of last dump: dict of stop key -> [version, digest, lat, lon]
+
+def load_snapshot (filename):
+
+	if not os.path.isfile(filename):
+		return {}
+
+	file = open(filename)
+	snapshot = json.load(file)
+	file.close()
+	return snapshot
+
+
+
+# Write osmChange file with changes since last dump, and save snapshot of this dump.
+# New and modified nodes are copied from the temporary diff files.
+# Nodes in the snapshot which were not produced in this dump are deleted.
+
+def save_diff (diff_filename, snapshot_filename):
+
+	diff_files['delete'] = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+	for stop_key, (stop_version, digest, lat, lon) in iter(snapshot.items()):
+		if stop_key not in new_snapshot:
+			diff_files['delete'].write ('    <node id="%i" lat="%s" lon="%s" />\n' % (get_node_id(stop_key), lat, lon))
+			diff_count['delete'] += 1
+
+	file = open(diff_filename, "w", encoding="utf-8")
+	file.write ('<?xml version="1.0" encoding="UTF-8"?>\n')
+	file.write ('<osmChange version="0.6" generator="nsr2osm v%s">\n' % version)
+	for action in ["create", "modify", "delete"]:
+		if diff_count[ action ] > 0:
+			file.write ('  <%s>\n' % action)
+			diff_files[ action ].seek(0)
+			shutil.copyfileobj(diff_files[ action ], file)
+			file.write ('  </%s>\n' % action)
+		diff_files[ action ].close()
+	file.write ('</osmChange>\n')
+	file.close()
+
+	file = open(snapshot_filename + ".part", "w")
+	json.dump(new_snapshot, file, separators=(",", ":"))
+	file.close()
+	os.replace(snapshot_filename + ".part", snapshot_filename)
+
+
+
+# Write collected lines to output file when there are enough of them for a large block, or at the end
+
+def flush_output (final=False):
+
+	if len(output) >= output_lines or final:
+		file_out.write("".join(output))
+		del output[:]
+
+
+
+# Open output file, compressed according to file extension (.gz, .bz2 or .zst)
+
+def open_output (filename):
+
+	if filename.endswith(".gz"):
+		return gzip.open(filename, "wt", encoding="utf-8")
+	elif filename.endswith(".bz2"):
+		return bz2.open(filename, "wt", encoding="utf-8")
+	elif filename.endswith(".zst"):
+		return TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(filename, "wb")), encoding="utf-8")
+	else:
+		return open(filename, "w", encoding="utf-8")
+
+
+
+# Get route name for route direction number, including operator and inbound/outbound information.
+# Each name is produced once and then reused.
+
+def get_route_name (number):
+
+	route_name = route_names[ number ]
+	if route_name is None:
+		route_id, direction = route_directions[ number ]
+		route = routes[ route_id ]
+		route_name = "[%s %s %s] %s" % (route['agency'], route['ref'], direction, route['name'])
+		route_name = route_name.replace("  ", "")
+		route_names[ number ] = route_name
+	return route_name
 
 
 
@@ -64,9 +224,12 @@ if __name__ == '__main__':
 
 	# Get county name
 
+	arguments = [ argument for argument in sys.argv[1:] if argument[0] != "-" ]
+	options = [ argument for argument in sys.argv[1:] if argument[0] == "-" ]
+
 	county = ""
-	if len(sys.argv) > 1:
-		query = sys.argv[1].lower().replace(u"Ø", "O").replace(u"ø", "o")
+	if arguments:
+		query = arguments[0].lower().replace(u"Ø", "O").replace(u"ø", "o")
 		if query.lower() in ["norge", "norway"]:
 			query = "current"
 		for filename in filenames:
@@ -77,6 +240,9 @@ if __name__ == '__main__':
 	if not(county):
 		sys.exit("County not found")
 
+	if "-zst" in options and zstandard is None:
+		sys.exit("Please install zstandard to produce .zst file")
+
 
 	# Get GTFS route files from Entur to match stops with routes later
 	# Load route names (lines)
@@ -84,8 +250,7 @@ if __name__ == '__main__':
 	message ("Loading routes... ")
 
 	url = "https://storage.googleapis.com/marduk-production/outbound/gtfs/rb_norway-aggregated-gtfs-basic.zip"
-	in_file = request.urlopen(url)
-	zip_file = zipfile.ZipFile(BytesIO(in_file.read()))
+	zip_file = nsr_feeds.open_feed(url)
 
 	file = zip_file.open("routes.txt")
 	file_csv = csv.DictReader(TextIOWrapper(file, "utf-8"), \
@@ -118,7 +283,8 @@ if __name__ == '__main__':
 					fieldnames=['route_id','trip_id','service_id','trip_headsign','direction_id'], delimiter=",")
 	next(file_csv)
 	
-	trips = {}
+	trips = {}  # Trip id -> route direction number
+	route_directions = {}  # (Route id, direction) -> route direction number
 
 	for row in file_csv:
 		if row['trip_id'] not in trips:
@@ -126,117 +292,104 @@ if __name__ == '__main__':
 				direction = "ut"  # outbound
 			else:
 				direction = "inn"  # inbound (value 1)
-			trips[ row['trip_id'] ] = {
-				'route': row['route_id'],
-				'direction': direction
-			}
+			route_direction = (row['route_id'], direction)
+			if route_direction not in route_directions:
+				route_directions[ route_direction ] = len(route_directions)
+			trips[ row['trip_id'] ] = route_directions[ route_direction ]
 
 	file.close()
 
 
 	# Load routes to discover quays in use from time table data
 
-	file = zip_file.open("stop_times.txt")
-	file_csv = csv.DictReader(TextIOWrapper(file, "utf-8"), fieldnames=['trip_id','stop_id'], delimiter=",")
-	next(file_csv)
-	
-	route_quays = {}
+	stop_trips = nsr_gtfs.scan_stop_trips(zip_file, trips, gtfs_workers)
+	zip_file.close()
 
-	for row in file_csv:
-		quay_id = row['stop_id'][9:]
-		if quay_id not in route_quays:
-			route_quays[quay_id] = []
-		route = routes[ trips[ row['trip_id'] ]['route'] ]
-		route_name = "[%s %s %s] %s" % (route['agency'], route['ref'], trips[ row['trip_id']]['direction'], route['name'])
-		route_name = route_name.replace("  ", "")
-		if route_name not in route_quays[quay_id]:
-			route_quays[quay_id].append(route_name)
+	route_quays = {}  # Quay id -> set of route direction numbers
 
-	file.close()
-	in_file.close()
+	for stop_id, numbers in iter(stop_trips.items()):
+		quay_id = stop_id[9:]
+		if quay_id in route_quays:
+			route_quays[quay_id].update(numbers)
+		else:
+			route_quays[quay_id] = numbers
+
+	route_directions = list(route_directions)  # Route direction number -> (route id, direction)
+	route_names = [None] * len(route_directions)  # Route direction number -> route name, produced when first used
 
 	message ("%s quays with routes\n" % len(route_quays))
 
 
-	# Load NeTEx stops/quays from Entur
+	# Open output file and produce OSM file header
 
-	message ("Loading NSR stops/quays... ")
+	filename = county
+	if county[0] in ['0', '1', '2', '5']:
+		filename = county[3:]
+	filename = "nsr_" + filename.lower().replace(" ", "_")
 
-	url = "https://storage.googleapis.com/marduk-production/tiamat/%s_latest.zip" % county.replace(" ", "%20")
+	pbf_file = None
+	if "-pbf" in options:
+		pbf_file = nsr_export.open_pbf(filename + ".osm.pbf", "nsr2osm v%s" % version)
 
-	in_file = request.urlopen(url)
-	zip_file = zipfile.ZipFile(BytesIO(in_file.read()))
-	filename = zip_file.namelist()[0]
-	file = zip_file.open(filename)
+	gpkg_file = None
+	if "-gpkg" in options:
+		gpkg_file = nsr_export.open_gpkg(filename + ".gpkg", "NSR stops and quays")
 
-	tree = ElementTree.parse(file)
-	file.close()
-	root = tree.getroot()
+	snapshot = None
+	if "-diff" in options:
+		diff_filename = filename + ".osc"
+		snapshot_filename = filename + "_snapshot.json"
+		snapshot = load_snapshot(snapshot_filename)
+		new_snapshot = {}  # Stop key -> [version, digest, lat, lon]
+		diff_files = {  # Temporary files with lines for new and modified nodes, so that they are not kept in memory
+			'create': tempfile.TemporaryFile(mode="w+", encoding="utf-8"),
+			'modify': tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+		}
+		diff_count = {'create': 0, 'modify': 0, 'delete': 0}
 
-	stop_places = root.find("ns0:dataObjects/ns0:SiteFrame/ns0:stopPlaces", ns)
+	filename += ".osm"
 
+	for option, extension in [("-gz", ".gz"), ("-bz2", ".bz2"), ("-zst", ".zst")]:
+		if option in options:
+			filename += extension
+			break
 
-	# Open output file and produce OSM file header
+	file_out = open_output(filename)
+	output = []  # Lines not yet written to output file
+	node_tags = []  # Tags of current node
 
-	message ("\nGenerating OSM file... ")
+	output.append ('<?xml version="1.0" encoding="UTF-8"?>\n')
+	output.append ('<osm version="0.6" generator="nsr2osm v%s">\n' % version)
 
-	filename = county
-	if county[0] in ['0', '1', '2', '5']:
-		filename = county[3:]
-	filename = "nsr_" + filename.lower().replace(" ", "_") + ".osm"
-
-	file_out = open(filename, "w")
+	node_count = 0
 
-	file_out.write ('<?xml version="1.0" encoding="UTF-8"?>\n')
-	file_out.write ('<osm version="0.6" generator="nsr2osm v%s">\n' % version)
 
-	node_id = -1000
+	# Load NeTEx stops/quays from Entur and generate OSM nodes while parsing
 
-	# Iterate all stops
+	message ("Loading NSR stops/quays and generating OSM file... ")
 
-	for stop_place in stop_places.iter('{%s}StopPlace' % ns_url):
+	url = "https://storage.googleapis.com/marduk-production/tiamat/%s_latest.zip" % county.replace(" ", "%20")
 
-		municipality = stop_place.find('ns0:TopographicPlaceRef', ns)
-		if municipality != None:
-			municipality = municipality.get('ref')
-			if municipality[0:3] != "KVE":
-				continue  # Skip stops abroad
-		else:
-			continue  # Skip stops abroad
+	zip_file = nsr_feeds.open_feed(url)
+	filename_netex = zip_file.namelist()[0]
+	file = zip_file.open(filename_netex)
 
-		municipality = municipality.replace("KVE:TopographicPlace:", "")
+	# Iterate all stops, one StopPlace at a time
 
-		# Get stop type
+	for stop_place in nsr_netex.iter_stops(file):
 
-		stop_type = stop_place.find('ns0:StopPlaceType', ns)
-		if stop_type != None:
-			stop_type = stop_type.text
-		else:
-			stop_type = ""
+		municipality = stop_place['municipality']
+		if not municipality:
+			continue  # Skip stops abroad
 
-		transport_mode = stop_place.find('ns0:TransportMode', ns)
-		if transport_mode != None:
-			transport_mode = transport_mode.text
-		else:
-			transport_mode = ""
+		# Get stop type
 
-		if transport_mode:
-			transport_submode = stop_place.find('ns0:%sSubmode' % transport_mode.title(), ns)
-			if transport_submode != None:
-				transport_submode = transport_submode.text
-			else:
-				transport_submode = ""
-		else:
-			transport_submode = ""
+		stop_type = stop_place['stop_type']
+		transport_submode = stop_place['submode']
 
 		# Get name
 
-		name = stop_place.find('ns0:Name', ns)
-		if name != None:
-			name = name.text
-		else:
-			name = ""
-		name = name.replace("  ", " ").strip()
+		name = stop_place['name']
 		full_name = ""
 
 		if stop_type == "railStation":
@@ -258,69 +411,50 @@ if __name__ == '__main__':
 		# Get any sami or kven names
 
 		languages = {}
-		alt_names = stop_place.find('ns0:alternativeNames', ns)
-		if alt_names != None:
-			norwegian_name = name
-			for alt_name in alt_names.iter('{%s}AlternativeName' % ns_url):
-				language_name = alt_name.find('ns0:Name', ns)
-				language = language_name.attrib['lang']
-				if language in ['sme', 'sma', 'smj', 'sms', 'fkv']:
-					language = language.replace("sme", "se")
-					languages[language] = language_name.text
-					name = languages[language] + " / " + name
+		norwegian_name = name
+		for language, language_name in stop_place['alt_names']:
+			if language in ['sme', 'sma', 'smj', 'sms', 'fkv']:
+				language = language.replace("sme", "se")
+				languages[language] = language_name
+				name = languages[language] + " / " + name
 
 		# Get wheelchair status
 
-		wheelchair = ""
-		accessibility = stop_place.find('ns0:AccessibilityAssessment', ns)
-		if accessibility != None:
-			wheelchair = accessibility.find('ns0:limitations/ns0:AccessibilityLimitation/ns0:WheelchairAccess', ns).text
-			if wheelchair == "unknown":
-				wheelchair = ""
-			elif wheelchair == "true":
-				wheelchair = "yes"
-			elif wheelchair == "partial":
-				wheelchair = "limited"
-			elif wheelchair == "false":
-				wheelchair = "no"
-
-		# Get toilet and bench status
-
-		toilet = False
-#		waiting_room = False
-
-		equipment = stop_place.find('ns0:placeEquipments', ns)
-		if equipment != None:
-			if equipment.find('ns0:SanitaryEquipment', ns) != None:
-				toilet = True
-#			if eqipment.find('ns0:WaitingRoomEquipment', ns):  # Not used
-#				waiting_room = True
+		wheelchair = stop_place['wheelchair']
+		if wheelchair == "unknown":
+			wheelchair = ""
+		elif wheelchair == "true":
+			wheelchair = "yes"
+		elif wheelchair == "partial":
+			wheelchair = "limited"
+		elif wheelchair == "false":
+			wheelchair = "no"
+
+		# Get toilet status
+
+		toilet = stop_place['toilet']
 
 		# Get comments, if any
 
 		note = ""
 		new_note = ""
 		tag = ""
-		key_list = stop_place.find('ns0:keyList', ns)
-
-		if key_list != None:
-			for key in key_list.iter('{%s}KeyValue' % ns_url):
-				key_name = key.find('ns0:Key', ns).text
-				key_value = key.find('ns0:Value', ns).text
-				if key_name:
-					if tag != key_name[0:6]:
-						if new_note:
-							note += ";" + new_note
-							new_note = ""
-						tag = key_name[0:6]
-
-					if "name" in key_name:
-						new_note += "[" + key_value + "]"
-					elif "comment" in key_name:
-						if key_value:
-							new_note += " " + key_value.replace("&lt;", "<")
-					elif "removed" in key_name:
+
+		for key_name, key_value in stop_place['keys']:
+			if key_name:
+				if tag != key_name[0:6]:
+					if new_note:
+						note += ";" + new_note
 						new_note = ""
+					tag = key_name[0:6]
+
+				if "name" in key_name:
+					new_note += "[" + key_value + "]"
+				elif "comment" in key_name:
+					if key_value:
+						new_note += " " + key_value.replace("&lt;", "<")
+				elif "removed" in key_name:
+					new_note = ""
 
 		if new_note:
 			note += ";" + new_note
@@ -331,13 +465,7 @@ if __name__ == '__main__':
 
 		if stop_type in ["busStation", "railStation"]:
 
-			node_id -= 1
-
-			location = stop_place.find('ns0:Centroid/ns0:Location', ns)
-			longitude = location.find('ns0:Longitude', ns).text
-			latitude = location.find('ns0:Latitude', ns).text
-
-			file_out.write ('  <node id="%i" lat="%s" lon="%s">\n' % (node_id, latitude, longitude))
+			node_count += 1
 
 			if stop_type == "busStation":
 				make_osm_line ("amenity", "bus_station")			
@@ -345,7 +473,7 @@ if __name__ == '__main__':
 				make_osm_line ("railway", "station")
 				make_osm_line ("train", "yes")
 
-			make_osm_line ("ref:nsrs", stop_place.get('id').replace("NSR:StopPlace:", ""))
+			make_osm_line ("ref:nsrs", stop_place['ref'])
 			make_osm_line ("name", name)
 
 			if languages:
@@ -368,148 +496,126 @@ if __name__ == '__main__':
 			make_osm_line ("MUNICIPALITY", municipality)
 			make_osm_line ("STOPTYPE", stop_type)
 			make_osm_line ("SUBMODE", transport_submode)
-			make_osm_line ("VERSION", stop_place.get('version'))
+			make_osm_line ("VERSION", stop_place['version'])
 			make_osm_line ("NSRNOTE", note)
+			make_osm_line ("QUAYS", str(len(stop_place['quays'])))
 
-			quays = stop_place.find('ns0:quays', ns)
-			count = 0
-			if quays != None:
-				for quay in quays.iter('{%s}Quay' % ns_url):
-					count += 1
-
-			make_osm_line ("QUAYS", str(count))
-
-			file_out.write ('  </node>\n')
+			make_osm_node ("s" + stop_place['ref'], stop_place['lat'], stop_place['lon'])
 
 
 		# Produce quay nodes
 
-		quays = stop_place.find('ns0:quays', ns)
-
-		if quays != None:
-			for quay in quays.iter('{%s}Quay' % ns_url):
-
-				node_id -= 1
-
-				location = quay.find('ns0:Centroid/ns0:Location', ns)
-				longitude = location.find('ns0:Longitude', ns).text
-				latitude = location.find('ns0:Latitude', ns).text
-
-				file_out.write ('  <node id="%i" lat="%s" lon="%s">\n' % (node_id, latitude, longitude))
-
-				if stop_type == "onstreetBus":
-					make_osm_line ("highway", "bus_stop")
-				elif stop_type == "busStation":
-					make_osm_line ("highway", "bus_stop")
-				elif stop_type == "onstreetTram":
-					make_osm_line ("railway", "tram_stop")
-					make_osm_line ("tram", "yes")
-				elif stop_type == "metroStation":
-					make_osm_line ("railway", "stop")
-					make_osm_line ("subway", "yes")
-				elif stop_type == "ferryStop":
-					make_osm_line ("amenity", "ferry_terminal")
-					make_osm_line ("foot", "yes")
-				elif stop_type == "harbourPort":
-					make_osm_line ("amenity", "ferry_terminal")
-					make_osm_line ("motor_vehicle", "yes")
-					make_osm_line ("foot", "yes")
-				elif stop_type == "railStation":
-					make_osm_line ("railway", "stop")
-					make_osm_line ("train", "yes")
-				elif stop_type == "airport":
-					if transport_submode == "helicopterService":
-						make_osm_line ("aeroway", "heliport")
-					else:
-						make_osm_line ("aeroway", "aerodrome")
-
-				public_code = quay.find('ns0:PublicCode', ns)
-				if public_code != None:
-					ref = public_code.text
+		for quay in stop_place['quays']:
+
+			node_count += 1
+
+			if stop_type == "onstreetBus":
+				make_osm_line ("highway", "bus_stop")
+			elif stop_type == "busStation":
+				make_osm_line ("highway", "bus_stop")
+			elif stop_type == "onstreetTram":
+				make_osm_line ("railway", "tram_stop")
+				make_osm_line ("tram", "yes")
+			elif stop_type == "metroStation":
+				make_osm_line ("railway", "stop")
+				make_osm_line ("subway", "yes")
+			elif stop_type == "ferryStop":
+				make_osm_line ("amenity", "ferry_terminal")
+				make_osm_line ("foot", "yes")
+			elif stop_type == "harbourPort":
+				make_osm_line ("amenity", "ferry_terminal")
+				make_osm_line ("motor_vehicle", "yes")
+				make_osm_line ("foot", "yes")
+			elif stop_type == "railStation":
+				make_osm_line ("railway", "stop")
+				make_osm_line ("train", "yes")
+			elif stop_type == "airport":
+				if transport_submode == "helicopterService":
+					make_osm_line ("aeroway", "heliport")
 				else:
-					ref = ""
+					make_osm_line ("aeroway", "aerodrome")
 
-				# Add public reference number/letter, if any, in parenteces in name (it is displayed on the quay)
+			ref = quay['public_code']
 
-				if ref:
-					make_osm_line ("name", name + " (" + ref + ")")
-					make_osm_line ("ref", ref)
-				else:
-					make_osm_line ("name", name)
-					private_code = quay.find('ns0:PrivateCode', ns)
-					if private_code != None:
-						ref = private_code.text
-						if ref and ref.strip():
-							make_osm_line ("unsigned_ref", ref)
+			# Add public reference number/letter, if any, in parenteces in name (it is displayed on the quay)
+
+			if ref:
+				make_osm_line ("name", name + " (" + ref + ")")
+				make_osm_line ("ref", ref)
+			else:
+				make_osm_line ("name", name)
+				ref = quay['private_code']
+				if ref and ref.strip():
+					make_osm_line ("unsigned_ref", ref)
+
+			if languages:
+				make_osm_line ("name:no", norwegian_name)
+				for language, language_name in iter(languages.items()):
+					make_osm_line ("name:%s" % language, language_name)
 
+			if full_name:
 				if languages:
-					make_osm_line ("name:no", norwegian_name)
-					for language, language_name in iter(languages.items()):
-						make_osm_line ("name:%s" % language, language_name)
-
-				if full_name:
-					if languages:
-						make_osm_line ("official_name:no", full_name)
-					else:
-						make_osm_line ("official_name", full_name)
-
-				# Shelters and monitors
-
-				equipment = quay.find('ns0:placeEquipments', ns)
-				if equipment != None:
-					shelter = equipment.find('ns0:ShelterEquipment', ns)
-					if shelter != None:
-						shelter = shelter.find('ns0:Enclosed', ns).text
-						if shelter == "true":
-							make_osm_line ("shelter", "yes")
-
-					for sign in equipment.iter('{%s}GeneralSign' % ns_url):
-						sign_content = sign.find('ns0:Content', ns)
-						if sign_content != None:
-							sign_content = sign_content.text
-							if sign_content == "RealtimeMonitor":
-								make_osm_line ("passenger_information_display", "yes")
-
-#						sign_code = sign.find('ns0:PrivateCode', ns)
-#						if sign_code != None:
-#							sign_code = sign_code.text
-#							if sign_content == "512":
-#								make_osm_line ("traffic_sign", "NO:512")
-
-				# Wheelchair status
-
-				accessibility = quay.find('ns0:AccessibilityAssessment', ns)
-				if accessibility != None:
-					wheelchair = accessibility.find('ns0:limitations/ns0:AccessibilityLimitation/ns0:WheelchairAccess', ns).text
-					if wheelchair == "true":
-						make_osm_line ("wheelchair", "yes")
-					elif wheelchair == "partial":
-						make_osm_line ("wheelchair", "limited")
-					elif wheelchair == "false":
-						make_osm_line ("wheelchair", "no")
-
-				elif wheelchair:  # Use StopPlace tag
-					make_osm_line ("wheelchair", wheelchair)
-
-				# Other tags
-
-				quay_id = quay.get('id').replace("NSR:Quay:", "")
-				make_osm_line ("ref:nsrq", quay_id)
-				make_osm_line ("MUNICIPALITY", municipality)
-				make_osm_line ("STOPTYPE", stop_type)
-				make_osm_line ("SUBMODE", transport_submode)
-				make_osm_line ("VERSION", quay.get('version'))
-				make_osm_line ("NSRNOTE", note)
-
-				if quay_id in route_quays:
-					make_osm_line("ROUTE", ";".join(sorted(route_quays[quay_id])))
-
-				file_out.write ('  </node>\n')
+					make_osm_line ("official_name:no", full_name)
+				else:
+					make_osm_line ("official_name", full_name)
+
+			# Shelters and monitors
+
+			if quay['shelter'] == "true":
+				make_osm_line ("shelter", "yes")
+
+			if "RealtimeMonitor" in quay['signs']:
+				make_osm_line ("passenger_information_display", "yes")
 
+			# Wheelchair status
+
+			if quay['wheelchair'] is not None:
+				if quay['wheelchair'] == "true":
+					make_osm_line ("wheelchair", "yes")
+				elif quay['wheelchair'] == "partial":
+					make_osm_line ("wheelchair", "limited")
+				elif quay['wheelchair'] == "false":
+					make_osm_line ("wheelchair", "no")
+
+			elif wheelchair:  # Use StopPlace tag
+				make_osm_line ("wheelchair", wheelchair)
+
+			# Other tags
+
+			quay_id = quay['ref']
+			make_osm_line ("ref:nsrq", quay_id)
+			make_osm_line ("MUNICIPALITY", municipality)
+			make_osm_line ("STOPTYPE", stop_type)
+			make_osm_line ("SUBMODE", transport_submode)
+			make_osm_line ("VERSION", quay['version'])
+			make_osm_line ("NSRNOTE", note)
+
+			if quay_id in route_quays:
+				make_osm_line("ROUTE", ";".join(sorted(set(get_route_name(number) for number in route_quays[quay_id]))))
+
+			make_osm_node ("q" + quay['ref'], quay['lat'], quay['lon'])
+
+	file.close()
+	zip_file.close()
 
 	# Produce OSM file footer
 
-	file_out.write ('</osm>\n')
+	output.append ('</osm>\n')
+	flush_output(final=True)
 	file_out.close()
 
-	message ("\n%i stops/quays saved to file '%s'\n\n" % ((-node_id - 1000), filename))
+	if pbf_file:
+		nsr_export.close_pbf(pbf_file)
+	if gpkg_file:
+		nsr_export.close_gpkg(gpkg_file)
+
+	message ("\n%i stops/quays saved to file '%s'\n" % (node_count, filename))
+
+	if snapshot is not None:
+		save_diff(diff_filename, snapshot_filename)
+		if not snapshot:
+			message ("No snapshot of last dump found, so all stops/quays are new\n")
+		message ("%i new, %i modified and %i deleted stops/quays since last dump saved to file '%s'\n"
+					% (diff_count['create'], diff_count['modify'], diff_count['delete'], diff_filename))
+
+	message ("\n")
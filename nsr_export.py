@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# nsr_export
+# Writers for OSM PBF and GeoPackage files for nsr2osm_dump.py, without external dependencies
+# Nodes are written one at a time while the OSM file is produced, so all formats are written in the same pass.
+# PBF: Protocol buffers are encoded by hand, with nodes in DenseNodes blocks compressed with zlib.
+# GeoPackage: One point layer with one column per tag, plus an R*Tree spatial index (sqlite3 module).
+
+
+import os
+import struct
+import zlib
+import sqlite3
+
+
+pbf_block_nodes = 8000  # Nodes per PBF block (recommended maximum)
+
+gpkg_table = "nsr_stops"  # Name of GeoPackage layer
+
+wgs84_definition = ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+					'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+					'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]')
+
+small_varints = [ bytes((value,)) for value in range(128) ]  # Encoded varints for the most common values
+
+
+
+# Encode unsigned integer as protocol buffer varint
+
+def varint (value):
+
+	if value < 128:
+		return small_varints[ value ]
+
+	data = bytearray()
+	while value > 127:
+		data.append((value & 127) | 128)
+		value >>= 7
+	data.append(value)
+	return bytes(data)
+
+
+
+# Encode signed integer with zigzag encoding (sint64)
+
+def zigzag (value):
+
+	if value < 0:
+		return (-value << 1) - 1
+	return value << 1
+
+
+
+# Encode length delimited protocol buffer field (bytes, string or embedded message)
+
+def bytes_field (number, data):
+
+	return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+
+# Encode varint protocol buffer field
+
+def varint_field (number, value):
+
+	return varint(number << 3) + varint(value)
+
+
+
+# Encode packed repeated varint protocol buffer field
+
+def packed_field (number, values):
+
+	return bytes_field(number, b"".join(map(varint, values)))
+
+
+
+# Write one PBF blob with header to file, compressed with zlib
+
+def write_pbf_blob (file, blob_type, data):
+
+	blob = varint_field(2, len(data)) + bytes_field(3, zlib.compress(data))
+	header = bytes_field(1, blob_type.encode()) + varint_field(3, len(blob))
+	file.write(struct.pack(">I", len(header)) + header + blob)
+
+
+
+# Open PBF file for writing nodes.
+# Returns dict with state of the file, to be used with write_pbf_node and close_pbf.
+
+def open_pbf (filename, program):
+
+	file = open(filename, "wb")
+
+	header_block = (bytes_field(4, b"OsmSchema-V0.6")
+					+ bytes_field(4, b"DenseNodes")
+					+ bytes_field(16, program.encode()))
+	write_pbf_blob(file, "OSMHeader", header_block)
+
+	return {
+		'file': file,
+		'nodes': []
+	}
+
+
+
+# Write collected nodes to PBF file as one primitive block with dense nodes.
+# Ids and coordinates are delta encoded. Coordinates use the default granularity of 100 nanodegrees.
+
+def write_pbf_block (pbf):
+
+	strings = {}  # String table from index 1, as index 0 is reserved for the delimiter in keys_vals (also for empty values)
+	ids = []
+	lats = []
+	lons = []
+	keys_vals = []
+	last_id = 0
+	last_lat = 0
+	last_lon = 0
+
+	for node_id, lat, lon, tags in pbf['nodes']:
+		lat = int(round(lat * 10000000))
+		lon = int(round(lon * 10000000))
+		ids.append(zigzag(node_id - last_id))
+		lats.append(zigzag(lat - last_lat))
+		lons.append(zigzag(lon - last_lon))
+		last_id = node_id
+		last_lat = lat
+		last_lon = lon
+
+		for key, value in tags:
+			keys_vals.append(strings.setdefault(key, len(strings) + 1))
+			keys_vals.append(strings.setdefault(value, len(strings) + 1))
+		keys_vals.append(0)
+
+	string_table = bytes_field(1, b"") + b"".join([ bytes_field(1, string.encode("utf-8")) for string in strings ])
+	dense_nodes = packed_field(1, ids) + packed_field(8, lats) + packed_field(9, lons) + packed_field(10, keys_vals)
+	primitive_block = bytes_field(1, string_table) + bytes_field(2, bytes_field(2, dense_nodes))
+
+	write_pbf_blob(pbf['file'], "OSMData", primitive_block)
+	pbf['nodes'] = []
+
+
+
+# Add node to PBF file
+# Parameters:
+# - lat, lon:	Coordinates as float
+# - tags:		List of (key, value)
+
+def write_pbf_node (pbf, node_id, lat, lon, tags):
+
+	pbf['nodes'].append((node_id, lat, lon, tags))
+	if len(pbf['nodes']) >= pbf_block_nodes:
+		write_pbf_block(pbf)
+
+
+
+# Write remaining nodes and close PBF file
+
+def close_pbf (pbf):
+
+	if pbf['nodes']:
+		write_pbf_block(pbf)
+	pbf['file'].close()
+
+
+
+# Open new GeoPackage file with one point layer for nodes.
+# Columns for tags are added when a tag key is first used.
+# Returns dict with state of the file, to be used with write_gpkg_node and close_gpkg.
+
+def open_gpkg (filename, description):
+
+	if os.path.isfile(filename):
+		os.remove(filename)
+
+	database = sqlite3.connect(filename)
+	database.execute("PRAGMA application_id = 1196444487")  # "GPKG"
+	database.execute("PRAGMA user_version = 10200")  # Version 1.2
+
+	database.executescript('''
+		CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY,
+			organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+		CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+			description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+			min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+			CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+		CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+			srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+			CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name), CONSTRAINT uk_gc_table_name UNIQUE (table_name),
+			CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+			CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+		CREATE TABLE gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL,
+			definition TEXT NOT NULL, scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name));
+	''')
+
+	database.executemany("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", [
+		("Undefined cartesian SRS", -1, "NONE", -1, "undefined", "undefined cartesian coordinate reference system"),
+		("Undefined geographic SRS", 0, "NONE", 0, "undefined", "undefined geographic coordinate reference system"),
+		("WGS 84 geodetic", 4326, "EPSG", 4326, wgs84_definition, "longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid")
+	])
+
+	database.execute('CREATE TABLE "%s" (fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geom POINT, osm_id INTEGER)' % gpkg_table)
+	database.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, description, srs_id) VALUES (?, 'features', ?, ?, 4326)",
+						(gpkg_table, gpkg_table, description))
+	database.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'POINT', 4326, 0, 0)", (gpkg_table,))
+
+	database.execute('CREATE VIRTUAL TABLE "rtree_%s_geom" USING rtree(id, minx, maxx, miny, maxy)' % gpkg_table)
+	database.execute("INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+						(gpkg_table,))
+
+	return {
+		'database': database,
+		'columns': set(),
+		'bbox': None
+	}
+
+
+
+# Add node to GeoPackage file as point with one column per tag
+# Parameters:
+# - lat, lon:	Coordinates as float
+# - tags:		List of (key, value)
+
+def write_gpkg_node (gpkg, node_id, lat, lon, tags):
+
+	database = gpkg['database']
+	tags = list(dict(tags).items())  # One column per key
+
+	for key, value in tags:
+		if key not in gpkg['columns']:
+			database.execute('ALTER TABLE "%s" ADD COLUMN "%s" TEXT' % (gpkg_table, key.replace('"', '""')))
+			gpkg['columns'].add(key)
+
+	# GeoPackage binary header (little endian, no envelope) followed by WKB point
+
+	geometry = b"GP\x00\x01" + struct.pack("<i", 4326) + struct.pack("<BIdd", 1, 1, lon, lat)
+
+	columns = "".join([ ', "%s"' % key.replace('"', '""') for key, value in tags ])
+	cursor = database.execute('INSERT INTO "%s" (geom, osm_id%s) VALUES (?, ?%s)' % (gpkg_table, columns, ", ?" * len(tags)),
+								[ geometry, node_id ] + [ value for key, value in tags ])
+	database.execute('INSERT INTO "rtree_%s_geom" VALUES (?, ?, ?, ?, ?)' % gpkg_table, (cursor.lastrowid, lon, lon, lat, lat))
+
+	if gpkg['bbox'] is None:
+		gpkg['bbox'] = [lon, lat, lon, lat]
+	else:
+		bbox = gpkg['bbox']
+		bbox[0] = min(bbox[0], lon)
+		bbox[1] = min(bbox[1], lat)
+		bbox[2] = max(bbox[2], lon)
+		bbox[3] = max(bbox[3], lat)
+
+
+
+# Triggers which keep the spatial index updated when the layer is edited later (GeoPackage rtree extension).
+# Created after all nodes have been written, as they use ST_* functions provided by GeoPackage readers.
+
+rtree_triggers = '''
+	CREATE TRIGGER "rtree_{t}_geom_insert" AFTER INSERT ON "{t}"
+		WHEN (new.geom NOT NULL AND NOT ST_IsEmpty(NEW.geom))
+	BEGIN
+		INSERT OR REPLACE INTO "rtree_{t}_geom" VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom));
+	END;
+	CREATE TRIGGER "rtree_{t}_geom_update1" AFTER UPDATE OF geom ON "{t}"
+		WHEN OLD.fid = NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))
+	BEGIN
+		INSERT OR REPLACE INTO "rtree_{t}_geom" VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom));
+	END;
+	CREATE TRIGGER "rtree_{t}_geom_update2" AFTER UPDATE OF geom ON "{t}"
+		WHEN OLD.fid = NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))
+	BEGIN
+		DELETE FROM "rtree_{t}_geom" WHERE id = OLD.fid;
+	END;
+	CREATE TRIGGER "rtree_{t}_geom_update3" AFTER UPDATE ON "{t}"
+		WHEN OLD.fid != NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))
+	BEGIN
+		DELETE FROM "rtree_{t}_geom" WHERE id = OLD.fid;
+		INSERT OR REPLACE INTO "rtree_{t}_geom" VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom));
+	END;
+	CREATE TRIGGER "rtree_{t}_geom_update4" AFTER UPDATE ON "{t}"
+		WHEN OLD.fid != NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))
+	BEGIN
+		DELETE FROM "rtree_{t}_geom" WHERE id IN (OLD.fid, NEW.fid);
+	END;
+	CREATE TRIGGER "rtree_{t}_geom_delete" AFTER DELETE ON "{t}"
+		WHEN old.geom NOT NULL
+	BEGIN
+		DELETE FROM "rtree_{t}_geom" WHERE id = OLD.fid;
+	END;
+'''
+
+
+
+# Update extent of layer, create spatial index triggers and close GeoPackage file
+
+def close_gpkg (gpkg):
+
+	database = gpkg['database']
+
+	if gpkg['bbox'] is not None:
+		database.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? WHERE table_name = ?",
+							gpkg['bbox'] + [ gpkg_table ])
+
+	database.commit()
+	database.executescript(rtree_triggers.format(t=gpkg_table))
+	database.close()
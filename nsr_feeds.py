@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# nsr_feeds
+# Shared download of Entur GTFS and NeTEx feeds for nsr2osm.py and nsr2osm_dump.py
+# Feeds are streamed in chunks to a local cache file on disk and opened from there as zip files,
+# so memory use does not depend on the size of the archive.
+# The cache is keyed by URL and uses ETag/Last-Modified, so unchanged feeds are not downloaded again.
+# Downloads use the shared keep-alive connections in nsr_http.
+
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import zipfile
+import urllib.request, urllib.error
+
+import nsr_http
+
+
+chunk_size = 1024 * 1024  # Bytes per read when downloading
+
+cache_folder = "~/.cache/nsr2osm"  # Folder for cached feeds, or None to always download to a temporary file
+
+request_header = {"User-Agent": "nsr2osm"}
+
+
+
+# Get paths of cached feed and its metadata for given url
+
+def cache_paths (url):
+
+	folder = os.path.expanduser(cache_folder)
+	key = hashlib.sha1(url.encode()).hexdigest()
+	return os.path.join(folder, key + ".zip"), os.path.join(folder, key + ".json")
+
+
+
+# Load metadata (url, etag, last_modified) for cached feed, or empty dict if not cached
+
+def load_cache_entry (url):
+
+	feed_path, meta_path = cache_paths(url)
+	if os.path.isfile(feed_path) and os.path.isfile(meta_path):
+		file = open(meta_path)
+		entry = json.load(file)
+		file.close()
+		if entry.get('url') == url:
+			return entry
+	return {}
+
+
+
+# Get version of cached feed (ETag, or else Last-Modified), or None if not known.
+# The version stays the same as long as the server responds 304 Not Modified in open_feed.
+
+def feed_version (url):
+
+	if not cache_folder:
+		return None
+	entry = load_cache_entry(url)
+	return entry.get('etag') or entry.get('last_modified')
+
+
+
+# Download feed and open it as a zip file.
+# A cached copy is used if the server responds 304 Not Modified.
+# Without cache folder, a temporary file is used which is deleted when the zip file is closed.
+
+def open_feed (url):
+
+	if not cache_folder:
+		in_file = nsr_http.open_url(urllib.request.Request(url, headers=request_header))
+		spool_file = tempfile.TemporaryFile()
+		shutil.copyfileobj(in_file, spool_file, chunk_size)
+		in_file.close()
+
+		spool_file.seek(0)
+		return zipfile.ZipFile(spool_file)
+
+	feed_path, meta_path = cache_paths(url)
+	os.makedirs(os.path.dirname(feed_path), exist_ok=True)
+
+	# Conditional request based on last download
+
+	entry = load_cache_entry(url)
+	header = dict(request_header)
+	if entry.get('etag'):
+		header['If-None-Match'] = entry['etag']
+	if entry.get('last_modified'):
+		header['If-Modified-Since'] = entry['last_modified']
+
+	try:
+		in_file = nsr_http.open_url(urllib.request.Request(url, headers=header))
+	except urllib.error.HTTPError as e:
+		if e.code == 304 and entry:  # Not modified
+			return zipfile.ZipFile(feed_path)
+		raise
+
+	# Download to temporary file in cache folder, then replace cached feed when complete
+
+	spool_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(feed_path), suffix=".part", delete=False)
+	try:
+		shutil.copyfileobj(in_file, spool_file, chunk_size)
+		spool_file.close()
+		os.replace(spool_file.name, feed_path)
+	except BaseException:
+		spool_file.close()
+		os.remove(spool_file.name)
+		raise
+	finally:
+		in_file.close()
+
+	entry = {
+		'url': url,
+		'etag': in_file.headers.get('ETag'),
+		'last_modified': in_file.headers.get('Last-Modified')
+	}
+	file = open(meta_path, "w")
+	json.dump(entry, file, indent=1)
+	file.close()
+
+	return zipfile.ZipFile(feed_path)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# nsr_gtfs
+# Shared scanning of Entur GTFS stop_times.txt for nsr2osm.py and nsr2osm_dump.py
+# Only the trip_id and stop_id columns are extracted, found by name from the header line.
+# The file is read in large blocks and the columns are extracted with one regular expression per block,
+# without building a dict (or list) for each row. Blocks are scanned as bytes, and only the unique values are decoded.
+# Optionally the decompressed file is split into byte ranges which are scanned in a pool of processes.
+
+
+import os
+import re
+import shutil
+import tempfile
+import concurrent.futures
+from operator import itemgetter
+from collections import defaultdict
+
+
+block_size = 16 * 1024 * 1024  # Bytes per block read from stop_times.txt
+
+
+
+# Get column positions for given column names from CSV header line
+
+def get_columns (header, names):
+
+	columns = [ column.strip().strip('"') for column in header.decode("utf-8-sig").strip().split(",") ]
+	for name in names:
+		if name not in columns:
+			raise ValueError("Column '%s' not found in GTFS file" % name)
+	return [ columns.index(name) for name in names ]
+
+
+
+# Build regular expression which captures the given columns of each line, in increasing column order.
+# Each line must be preceded by a line feed (see iter_blocks), which lets the regex engine jump between lines.
+# Quotes around values are omitted. Quoted values may not contain commas (not used for ids).
+# Parameter:
+# - strict:	If False, skipped columns may contain line feeds, which is about 40% faster in the regex engine.
+#			A line with too few columns then merges with the next line, which is detected in find_rows.
+
+def column_pattern (columns, strict=True):
+
+	if strict:
+		skip = b"[^,\\n]*,"
+	else:
+		skip = b"[^,]*,"
+
+	pattern = b"\\n"
+	position = 0
+	for column in sorted(columns):
+		if position > 0:
+			pattern += b'"?,'
+		pattern += skip * (column - position)
+		pattern += b'"?([^,"\\r\\n]*)'
+		position = column + 1
+
+	return re.compile(pattern)
+
+
+
+# Find captured columns for all lines in block.
+# The fast pattern is used first, and the strict pattern if not every line gave a match.
+
+def find_rows (block, patterns):
+
+	rows = patterns[0].findall(block)
+	if len(rows) != block.count(b"\n"):
+		rows = patterns[1].findall(block)
+	return rows
+
+
+
+# Get fast and strict patterns for find_rows
+
+def column_patterns (columns):
+
+	return (column_pattern(columns, strict=False), column_pattern(columns))
+
+
+
+# Iterate blocks of complete lines from CSV file (after header line), as bytes.
+# Each line in a block is preceded by a line feed.
+# Parameter:
+# - size:	Number of bytes to read from current position, or None to read to end of file
+
+def iter_blocks (file, size=None):
+
+	rest = b""
+	while size is None or size > 0:
+		if size is None:
+			block = file.read(block_size)
+		else:
+			block = file.read(min(block_size, size))
+			size -= len(block)
+		if not block:
+			break
+		block = rest + block
+		end = block.rfind(b"\n")
+		if end < 0:
+			rest = block
+			continue
+		rest = block[ end + 1: ]
+		yield b"\n" + block[ :end ]
+
+	if rest:
+		yield b"\n" + rest
+
+
+
+# Get set of values (bytes) in given column (one column in patterns)
+
+def scan_values (file, patterns, size=None):
+
+	values = set()
+	for block in iter_blocks(file, size):
+		values.update(find_rows(block, patterns))
+	return values
+
+
+
+# Get set of unique (stop_id, trip number) pairs, with stop_id as bytes (trip and stop column in patterns)
+# Parameters:
+# - trip_first:		True if trip_id column is before stop_id column
+# - trip_numbers:	Dict of trip_id (bytes) -> trip number
+
+def scan_pairs (file, patterns, trip_first, trip_numbers, size=None):
+
+	get_trip = itemgetter(int(not trip_first))
+	get_stop = itemgetter(int(trip_first))
+
+	# Collect unique pairs without a Python loop per row
+
+	pairs = set()
+	for block in iter_blocks(file, size):
+		rows = find_rows(block, patterns)
+		numbers = map(trip_numbers.__getitem__, map(get_trip, rows))
+		pairs.update(zip(map(get_stop, rows), numbers))
+	return pairs
+
+
+
+# Worker process: keep trip numbers for all scans in this process
+
+def init_worker (trip_numbers):
+
+	global worker_trip_numbers
+	worker_trip_numbers = trip_numbers
+
+
+
+# Worker process: scan one byte range of decompressed stop_times.txt
+# Parameter:
+# - task:	Tuple of (filename, begin, end, columns, trip_first), where trip_first is None if only one column is scanned
+
+def scan_range (task):
+
+	filename, begin, end, columns, trip_first = task
+	patterns = column_patterns(columns)
+
+	file = open(filename, "rb")
+	file.seek(begin)
+	if trip_first is None:
+		result = scan_values(file, patterns, end - begin)
+	else:
+		result = scan_pairs(file, patterns, trip_first, worker_trip_numbers, end - begin)
+	file.close()
+	return result
+
+
+
+# Decompress stop_times.txt to a temporary file and split it into byte ranges aligned to line boundaries,
+# then scan the ranges in a pool of processes.
+# Returns a list of the partial sets, one for each range.
+
+def scan_parallel (zip_file, columns, trip_first, trip_numbers, workers):
+
+	file = zip_file.open("stop_times.txt")
+	spool_file = tempfile.NamedTemporaryFile(suffix=".txt", delete=False)
+	try:
+		shutil.copyfileobj(file, spool_file, block_size)
+		spool_file.close()
+		file.close()
+
+		# Find range boundaries at line starts, after header line
+
+		spool_file = open(spool_file.name, "rb")
+		spool_file.readline()
+		boundaries = [ spool_file.tell() ]
+		size = os.path.getsize(spool_file.name)
+		for i in range(1, workers):
+			spool_file.seek(max(boundaries[-1], size * i // workers))
+			spool_file.readline()
+			boundaries.append(spool_file.tell())
+		boundaries.append(size)
+		spool_file.close()
+
+		tasks = [ (spool_file.name, begin, end, columns, trip_first) for begin, end in zip(boundaries[:-1], boundaries[1:]) if end > begin ]
+
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(trip_numbers,)) as pool:
+			return list(pool.map(scan_range, tasks))
+
+	finally:
+		spool_file.close()
+		os.remove(spool_file.name)
+
+
+
+# Get number of worker processes to use (0 means one per CPU)
+
+def get_workers (workers):
+
+	if workers == 0:
+		return os.cpu_count() or 1
+	return max(workers, 1)
+
+
+
+# Get set of all stop_id's in stop_times.txt
+# Parameter:
+# - workers:	Number of processes for scanning (1 to scan in this process, 0 for one per CPU)
+
+def scan_stop_ids (zip_file, workers=1):
+
+	workers = get_workers(workers)
+
+	file = zip_file.open("stop_times.txt")
+	columns = get_columns(file.readline(), ["stop_id"])
+
+	if workers > 1:
+		file.close()
+		stop_ids = set().union(*scan_parallel(zip_file, columns, None, None, workers))
+	else:
+		stop_ids = scan_values(file, column_patterns(columns))
+		file.close()
+
+	stop_ids.discard(b"")
+	return set(stop_id.decode("utf-8") for stop_id in stop_ids)
+
+
+
+# Get dict of stop_id -> set of trip keys, for all stops in stop_times.txt
+# Parameters:
+# - trip_keys:	Dict of trip_id -> hashable key for the trip (e.g. route and direction)
+# - workers:	Number of processes for scanning (1 to scan in this process, 0 for one per CPU)
+
+def scan_stop_trips (zip_file, trip_keys, workers=1):
+
+	workers = get_workers(workers)
+
+	# Use small integers for trip keys while scanning, as they are faster to hash and to pass between processes.
+	# Trip ids are encoded, as blocks are scanned as bytes.
+
+	key_numbers = {}
+	trip_numbers = {}
+	for trip_id, key in iter(trip_keys.items()):
+		if key not in key_numbers:
+			key_numbers[ key ] = len(key_numbers)
+		trip_numbers[ trip_id.encode("utf-8") ] = key_numbers[ key ]
+	keys = list(key_numbers)
+
+	file = zip_file.open("stop_times.txt")
+	columns = get_columns(file.readline(), ["trip_id", "stop_id"])
+	trip_first = columns[0] < columns[1]
+
+	if workers > 1:
+		file.close()
+		pairs = set().union(*scan_parallel(zip_file, columns, trip_first, trip_numbers, workers))
+	else:
+		pairs = scan_pairs(file, column_patterns(columns), trip_first, trip_numbers)
+		file.close()
+
+	stop_trips = defaultdict(set)
+	for stop_id, number in pairs:
+		stop_trips[ stop_id.decode("utf-8") ].add(keys[ number ])
+
+	return dict(stop_trips)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# nsr_http
+# Shared HTTP session for nsr2osm.py and nsr2osm_dump.py
+# Connections are kept alive and reused for later requests to the same host, so each TLS handshake is done only once.
+# Responses are streamed, and gzip content encoding is decompressed while reading.
+# Errors are raised as urllib.error.HTTPError and URLError, so callers may handle them as for urllib.request.urlopen.
+# The connection pool is shared between threads.
+# Proxies are used as given by the HTTP_PROXY, HTTPS_PROXY and NO_PROXY environment variables, as for urllib.
+
+
+import io
+import gzip
+import base64
+import time
+import threading
+import email.utils
+import http.client
+import urllib.request, urllib.error, urllib.parse
+
+
+pool_size = 4  # Maximum number of idle connections kept open for each host
+timeout = 900  # Seconds to wait for connection or data; must be longer than the longest Overpass query timeout (600 seconds)
+max_redirects = 5  # Maximum number of redirects to follow for one request
+drain_size = 65536  # Bytes of unread body which are read when a response is closed, to keep the connection
+idempotent_methods = ["GET", "HEAD", "PUT", "DELETE", "OPTIONS"]  # Requests which may be sent again if a kept-alive connection fails
+
+retry_delay = 10  # Seconds to wait before first retry if the server gives no Retry-After; doubled for each retry
+max_retry_delay = 600  # Maximum seconds to wait before a retry
+
+request_header = {"User-Agent": "nsr2osm", "Accept-Encoding": "gzip"}
+
+idle_connections = {}  # (scheme, host) -> list of idle connections
+pool_lock = threading.Lock()
+
+
+
+# Get proxy for scheme and host from environment, or None if no proxy should be used.
+# Returns tuple of proxy host (with port) and header for proxy authorization.
+
+def get_proxy (scheme, host):
+
+	proxy = urllib.request.getproxies().get(scheme, None)
+	if not proxy or urllib.request.proxy_bypass(host):
+		return None
+
+	if "://" not in proxy:
+		proxy = "http://" + proxy
+	parts = urllib.parse.urlsplit(proxy)
+
+	header = {}
+	if parts.username:
+		authorization = urllib.parse.unquote(parts.username) + ":" + urllib.parse.unquote(parts.password or "")
+		header['Proxy-Authorization'] = "Basic " + base64.b64encode(authorization.encode()).decode()
+
+	return (parts.netloc.rpartition("@")[2], header)
+
+
+
+# Get idle connection to host from pool, or open a new connection.
+# Https connections through a proxy use a tunnel to the host.
+# Returns tuple of connection and True if it has been used before.
+# Parameter:
+# - reuse:	False to always open a new connection
+
+def get_connection (scheme, host, reuse=True):
+
+	if reuse:
+		with pool_lock:
+			connections = idle_connections.get((scheme, host), [])
+			if connections:
+				return connections.pop(), True
+
+	proxy = get_proxy(scheme, host)
+
+	if scheme == "https":
+		if proxy:
+			connection = http.client.HTTPSConnection(proxy[0], timeout=timeout)
+			connection.set_tunnel(host, headers=proxy[1])
+			return connection, False
+		return http.client.HTTPSConnection(host, timeout=timeout), False
+	else:
+		return http.client.HTTPConnection(proxy[0] if proxy else host, timeout=timeout), False
+
+
+
+# Return connection to pool for later requests, or close it if the pool for the host is full
+
+def release_connection (scheme, host, connection):
+
+	with pool_lock:
+		connections = idle_connections.setdefault((scheme, host), [])
+		if len(connections) < pool_size:
+			connections.append(connection)
+			return
+
+	connection.close()
+
+
+
+# Close all idle connections
+
+def close_connections():
+
+	with pool_lock:
+		for connections in idle_connections.values():
+			for connection in connections:
+				connection.close()
+		idle_connections.clear()
+
+
+
+# Response from open_url, streaming the body from the connection.
+# The connection is returned to the pool when the response is closed, if the rest of the body is small enough to be read.
+
+class Response (io.RawIOBase):
+
+	def __init__ (self, response, scheme, host, connection, url):
+
+		self.response = response
+		self.scheme = scheme
+		self.host = host
+		self.connection = connection
+		self.url = url
+		self.status = response.status
+		self.reason = response.reason
+		self.headers = response.headers
+
+		if (response.getheader("Content-Encoding") or "").lower() == "gzip":
+			self.body = gzip.GzipFile(fileobj=response)
+		else:
+			self.body = response
+
+	def readable (self):
+		return True
+
+	def readinto (self, buffer):
+		data = self.body.read(len(buffer))
+		buffer[ :len(data) ] = data
+		return len(data)
+
+	def read (self, size=-1):
+		if size is None or size < 0:
+			return self.body.read()
+		return self.body.read(size)
+
+	def geturl (self):
+		return self.url
+
+	def close (self):
+		if self.connection is not None:
+			if not self.response.isclosed() and self.response.length is not None and self.response.length <= drain_size:
+				try:
+					self.response.read()
+				except (OSError, http.client.HTTPException):
+					pass
+			if self.response.isclosed() and not self.response.will_close:  # Body has been read to the end
+				release_connection(self.scheme, self.host, self.connection)
+			else:
+				self.response.close()
+				self.connection.close()
+			self.connection = None
+		super().close()
+
+
+
+# Get seconds to wait before given retry (0 for first retry).
+# The Retry-After header is used if given by the server (seconds or date), else the delay is doubled for each retry.
+
+def get_retry_delay (headers, tries):
+
+	value = headers.get("Retry-After") if headers is not None else None
+	if value:
+		value = value.strip()
+		if value.isdigit():
+			return min(int(value), max_retry_delay)
+		try:
+			date = email.utils.parsedate_to_datetime(value)
+			return min(max(int(date.timestamp() - time.time()) + 1, 0), max_retry_delay)
+		except (TypeError, ValueError):
+			pass
+
+	return min(retry_delay * 2**tries, max_retry_delay)
+
+
+
+# Send one request on a pooled connection and get the response.
+# A connection kept alive may have been closed by the server, in which case the request is sent again on a new connection.
+# Other requests than idempotent_methods (e.g. POST) may already have been processed by the server when the connection fails,
+# so they are always sent on a new connection and never sent again.
+# Http requests through a proxy are sent to the proxy with the full url.
+
+def send_request (scheme, host, method, path, data, header):
+
+	proxy = get_proxy(scheme, host)
+	if proxy and scheme == "http":
+		path = "http://" + host + path
+		header = dict(header)
+		header.update(proxy[1])
+
+	reuse = method in idempotent_methods
+
+	while True:
+		connection, reused = get_connection(scheme, host, reuse)
+		try:
+			connection.request(method, path, body=data, headers=header)
+			return connection, connection.getresponse()
+		except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+			connection.close()
+			if not reused:
+				raise urllib.error.URLError(e)
+		except (OSError, http.client.HTTPException) as e:
+			connection.close()
+			raise urllib.error.URLError(e)
+
+
+
+# Open url with a pooled connection, following redirects.
+# The Authorization header is dropped when redirected to another scheme or host.
+# Returns file-like Response (with status, headers and read/close), or raises HTTPError for status 304 and 400 or above.
+# Parameter:
+# - url:	Url string or urllib.request.Request (for header, data and method)
+
+def open_url (url):
+
+	if isinstance(url, str):
+		url = urllib.request.Request(url)
+
+	full_url = url.full_url
+	method = url.get_method()
+	data = url.data
+	header = dict(url.header_items())
+	keys = set(key.lower() for key in header)
+	for key, value in iter(request_header.items()):
+		if key.lower() not in keys:
+			header[ key ] = value
+	if data is not None and "content-type" not in keys:
+		header['Content-Type'] = "application/x-www-form-urlencoded"
+
+	for redirect in range(max_redirects + 1):
+		parts = urllib.parse.urlsplit(full_url)
+		path = parts.path or "/"
+		if parts.query:
+			path += "?" + parts.query
+
+		connection, response = send_request(parts.scheme, parts.netloc, method, path, data, header)
+		file = Response(response, parts.scheme, parts.netloc, connection, full_url)
+
+		if response.status in [301, 302, 303, 307, 308] and response.getheader("Location") and redirect < max_redirects:
+			file.read()
+			file.close()
+			full_url = urllib.parse.urljoin(full_url, response.getheader("Location"))
+
+			# Do not send credentials to another scheme or host
+
+			new_parts = urllib.parse.urlsplit(full_url)
+			if new_parts.scheme != parts.scheme or new_parts.netloc != parts.netloc:
+				header = dict((key, value) for key, value in iter(header.items()) if key.lower() != "authorization")
+
+			if response.status == 303 or response.status in [301, 302] and method == "POST":
+				method = "GET"
+				data = None
+			continue
+
+		if response.status >= 400 or response.status == 304:
+			body = file.read()
+			file.close()
+			raise urllib.error.HTTPError(full_url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+		return file
+
+	raise urllib.error.HTTPError(full_url, response.status, "Too many redirects", response.headers, None)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# nsr_netex
+# Shared NeTEx extraction for nsr2osm.py and nsr2osm_dump.py
+# Reads StopPlace and Quay elements from Entur NeTEx files (XML) into compact dicts, one StopPlace at a time
+# Each element is read in a single pass over its children, dispatching on tag name
+
+
+from xml.etree import ElementTree
+
+
+ns_url = 'http://www.netex.org.uk/netex'
+
+ns_prefix = '{%s}' % ns_url
+ns_length = len(ns_prefix)
+
+stop_places_tag = ns_prefix + 'stopPlaces'
+stop_place_tag = ns_prefix + 'StopPlace'
+
+
+
+# Iterate StopPlace elements in NeTEx file without loading the whole document into memory.
+# Each StopPlace is cleared and detached from the tree after it has been processed by the caller.
+# All other elements outside of StopPlaces (topographic places, parkings, tariff zones etc.) are cleared and detached
+# as soon as they are complete, so that memory use does not grow with the size of the file.
+
+def iter_stop_places (file):
+
+	parents = []  # Open elements from the root
+	stop_place_depth = 0  # Number of open StopPlace elements (StopPlaces may be nested in parent StopPlaces)
+
+	for event, element in ElementTree.iterparse(file, events=("start", "end")):
+		if event == "start":
+			parents.append(element)
+			if element.tag == stop_place_tag:
+				stop_place_depth += 1
+			continue
+
+		parents.pop()
+
+		if element.tag == stop_place_tag:
+			stop_place_depth -= 1
+			if stop_place_depth == 0:
+				yield element
+		elif stop_place_depth > 0:
+			continue  # Part of StopPlace which is still being read
+
+		element.clear()
+		if parents and len(parents[-1]) and parents[-1][-1] is element:
+			del parents[-1][-1]  # Always the last child, so constant time
+
+
+
+# Iterate all stops in NeTEx file as compact dicts (see parse_stop_place)
+
+def iter_stops (file):
+
+	for stop_place in iter_stop_places(file):
+		yield parse_stop_place(stop_place)
+
+
+
+# Get local tag name without namespace (all NeTEx elements are in the same namespace)
+
+def local_name (element):
+
+	return element.tag[ ns_length: ]
+
+
+
+# Get (longitude, latitude) text from Centroid element
+
+def get_location (centroid):
+
+	longitude = None
+	latitude = None
+	for location in centroid:
+		for coordinate in location:
+			name = local_name(coordinate)
+			if name == "Longitude":
+				longitude = coordinate.text
+			elif name == "Latitude":
+				latitude = coordinate.text
+	return longitude, latitude
+
+
+
+# Get WheelchairAccess text from AccessibilityAssessment element, or "" if not given
+
+def get_wheelchair (accessibility):
+
+	for limitations in accessibility:
+		for limitation in limitations:
+			for access in limitation:
+				if local_name(access) == "WheelchairAccess":
+					return access.text
+	return ""
+
+
+
+# Get text of first child element with given local name, or None
+
+def get_child_text (element, name):
+
+	for child in element:
+		if local_name(child) == name:
+			return child.text
+	return None
+
+
+
+# Convert Quay element to dict:
+# - ref, version:				NSR quay reference without "NSR:Quay:" prefix, and version
+# - lon, lat:					Coordinate text (None if missing)
+# - public_code, private_code:	Text of PublicCode and PrivateCode (None if missing)
+# - wheelchair:					WheelchairAccess text, or None if quay has no AccessibilityAssessment
+# - shelter:					Enclosed text of ShelterEquipment (None if missing)
+# - signs:						List of GeneralSign contents
+
+def parse_quay (quay):
+
+	record = {
+		'ref': quay.get('id').replace("NSR:Quay:", ""),
+		'version': quay.get('version'),
+		'lon': None,
+		'lat': None,
+		'public_code': None,
+		'private_code': None,
+		'wheelchair': None,
+		'shelter': None,
+		'signs': []
+	}
+
+	for child in quay:
+		name = local_name(child)
+
+		if name == "Centroid":
+			record['lon'], record['lat'] = get_location(child)
+
+		elif name == "PublicCode":
+			record['public_code'] = child.text
+
+		elif name == "PrivateCode":
+			record['private_code'] = child.text
+
+		elif name == "AccessibilityAssessment":
+			record['wheelchair'] = get_wheelchair(child)
+
+		elif name == "placeEquipments":
+			for equipment in child:
+				equipment_name = local_name(equipment)
+				if equipment_name == "ShelterEquipment":
+					record['shelter'] = get_child_text(equipment, "Enclosed")
+				elif equipment_name == "GeneralSign":
+					content = get_child_text(equipment, "Content")
+					if content is not None:
+						record['signs'].append(content)
+
+	return record
+
+
+
+# Convert StopPlace element to dict:
+# - ref, version:		NSR stop place reference without "NSR:StopPlace:" prefix, and version
+# - name:				Name with double spaces removed
+# - alt_names:			List of (language, name) from alternativeNames
+# - municipality:		Four digit municipality ref, or "" if stop is abroad
+# - stop_type:			StopPlaceType text, or ""
+# - transport_mode:		TransportMode text, or ""
+# - submode:			Submode matching transport mode, or ""
+# - lon, lat:			Coordinate text (None if missing)
+# - wheelchair:			WheelchairAccess text, or ""
+# - toilet:				True if SanitaryEquipment is present
+# - keys:				List of (key, value) from keyList
+# - quays:				List of quay dicts (see parse_quay)
+
+def parse_stop_place (stop_place):
+
+	record = {
+		'ref': stop_place.get('id').replace("NSR:StopPlace:", ""),
+		'version': stop_place.get('version'),
+		'name': "",
+		'alt_names': [],
+		'municipality': "",
+		'stop_type': "",
+		'transport_mode': "",
+		'submode': "",
+		'lon': None,
+		'lat': None,
+		'wheelchair': "",
+		'toilet': False,
+		'keys': [],
+		'quays': []
+	}
+
+	submodes = {}
+
+	for child in stop_place:
+		name = local_name(child)
+
+		if name == "Name":
+			if child.text:
+				record['name'] = child.text.replace("  ", " ").strip()
+
+		elif name == "StopPlaceType":
+			record['stop_type'] = child.text or ""
+
+		elif name == "TransportMode":
+			record['transport_mode'] = child.text or ""
+
+		elif name[-7:] == "Submode":
+			submodes[ name ] = child.text or ""
+
+		elif name == "TopographicPlaceRef":
+			municipality = child.get('ref')
+			if municipality and municipality[0:3] == "KVE":
+				record['municipality'] = municipality.replace("KVE:TopographicPlace:", "")
+
+		elif name == "Centroid":
+			record['lon'], record['lat'] = get_location(child)
+
+		elif name == "quays":
+			for quay in child:
+				if local_name(quay) == "Quay":
+					record['quays'].append(parse_quay(quay))
+
+		elif name == "alternativeNames":
+			for alt_name in child:
+				for language_name in alt_name:
+					if local_name(language_name) == "Name":
+						record['alt_names'].append((language_name.get('lang'), language_name.text))
+
+		elif name == "AccessibilityAssessment":
+			record['wheelchair'] = get_wheelchair(child)
+
+		elif name == "placeEquipments":
+			for equipment in child:
+				if local_name(equipment) == "SanitaryEquipment":
+					record['toilet'] = True
+
+		elif name == "keyList":
+			for key_value in child:
+				record['keys'].append((get_child_text(key_value, "Key"), get_child_text(key_value, "Value")))
+
+	if record['transport_mode']:
+		record['submode'] = submodes.get(record['transport_mode'].title() + "Submode", "")
+
+	return record